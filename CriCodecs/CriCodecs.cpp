@@ -4,15 +4,20 @@
 #include "adx.cpp"
 #include "crilayla.cpp"
 #include "hca.cpp"
+#include "utf.cpp"
 
 static struct PyMethodDef Codec_methods[] = {
     { "AdxDecode", (PyCFunction)AdxDecode, METH_O, nullptr },
     { "AdxEncode", (PyCFunction)AdxEncode, METH_VARARGS, nullptr },
     { "CriLaylaDecompress", (PyCFunction)CriLaylaDecompress, METH_O, nullptr },
+    { "CriLaylaDecompressInto", (PyCFunction)CriLaylaDecompressInto, METH_VARARGS, nullptr },
+    { "CriLaylaSize", (PyCFunction)CriLaylaSize, METH_O, nullptr },
     { "CriLaylaCompress", (PyCFunction)CriLaylaCompress, METH_VARARGS, nullptr },
     { "HcaDecode", (PyCFunction)HcaDecode, METH_VARARGS, nullptr },
     { "HcaEncode", (PyCFunction)HcaEncode, METH_VARARGS, nullptr },
     { "HcaCrypt", (PyCFunction)HcaCrypt, METH_VARARGS, nullptr },
+    { "UtfParse", (PyCFunction)UtfParse, METH_O, nullptr },
+    { "UtfCrypt", (PyCFunction)UtfCrypt, METH_VARARGS, nullptr },
     { nullptr, nullptr, 0, nullptr }
 };
 
@@ -3,9 +3,8 @@
 	written by tpu. (https://forum.xentax.com/viewtopic.php?f=21&t=5137&p=44220&hilit=CRILAYLA#p44220)
 	Python wrapper by me (and modification).
 
-	CRIcompress method by KenTse
-    Taken from wmltogether's fork of CriPakTools.
-    Python wrapper by me.
+	Compression originally by KenTse (from wmltogether's fork of CriPakTools),
+	now a hash chain LZ77 that writes the same stream format.
 
 	Note: I have no idea how this compression technique works. I just made the wrapper.
 */
@@ -23,53 +22,62 @@ struct crilayla_header{
 };
 
 
-unsigned char *sbuf;
-unsigned int bitcnt;
-unsigned int bitdat;
-unsigned int get_bits(unsigned int n){
+// Bit reader state, kept per call so that decoding is reentrant and can run without the GIL.
+struct layla_bits{
+    const unsigned char *sbuf;
+    const unsigned char *start;
+    unsigned int bitcnt;
+    unsigned int bitdat;
+};
+
+static inline unsigned int get_bits(layla_bits &bits, unsigned int n){
 	unsigned int data, mask;
 
-    if (bitcnt<n){
-	  data = ((24-bitcnt)>>3)+1;
-	  bitcnt += data*8;
+    if (bits.bitcnt<n){
+	  data = ((24-bits.bitcnt)>>3)+1;
+	  bits.bitcnt += data*8;
       while(data) {
-		bitdat = (bitdat<<8) | (*sbuf--);
+		// Reading past the start of the stream only happens on corrupted data, yields zeros.
+		bits.bitdat = (bits.bitdat<<8) | (bits.sbuf >= bits.start ? *bits.sbuf-- : 0);
 		data--;
       }
     }
 
-	data = bitdat>>(bitcnt-n);
-	bitcnt -= n;
+	data = bits.bitdat>>(bits.bitcnt-n);
+	bits.bitcnt -= n;
 	mask = (1<<n)-1;
 	data &= mask;
 	return data;
 }
 
-unsigned int llcp_dec(unsigned char *src, unsigned int src_len, unsigned char *dst, unsigned int dst_len){
+// Returns the number of decoded bytes, or 0 if a match points outside of the output.
+unsigned int llcp_dec(const unsigned char *src, unsigned int src_len, unsigned char *dst, unsigned int dst_len){
 	unsigned char *dbuf, *pbuf;
 	unsigned int plen, poffset, byte;
+	layla_bits bits = { src+src_len-1, src, 0, 0 };
+	unsigned char *dend = dst+dst_len;
 
-	sbuf = src+src_len-1;
 	dbuf = dst+dst_len-1;
-	bitcnt = 0;
+	if(dst_len == 0)
+		return 0;
 
 	while(1){
-		if(get_bits(1)==0){
-			byte = get_bits(8);
+		if(get_bits(bits, 1)==0){
+			byte = get_bits(bits, 8);
 			*dbuf-- = byte;
 			if((dbuf+1)==dst)
 				goto _done;
 		}else{
-			poffset = get_bits(13);
+			poffset = get_bits(bits, 13);
 
-			plen = get_bits(2);
+			plen = get_bits(bits, 2);
 			if(plen==3){
-				plen += get_bits(3);
+				plen += get_bits(bits, 3);
 				if(plen==10){
-					plen += get_bits(5);
+					plen += get_bits(bits, 5);
 					if(plen==41){
 						do{
-							byte = get_bits(8);
+							byte = get_bits(bits, 8);
 							plen += byte;
 						}while(byte==255);
 					}
@@ -78,6 +86,8 @@ unsigned int llcp_dec(unsigned char *src, unsigned int src_len, unsigned char *d
 
 			pbuf = dbuf+poffset+3;
 			plen += 3;
+			if(pbuf >= dend)
+				return 0;
 
 			while(plen) {
 				byte = *pbuf--;
@@ -94,133 +104,405 @@ _done:
 	return (unsigned int)(dst+dst_len-dbuf-1);
 }
 
+/*
+    Compression.
+    CRILAYLA streams are decoded from the end of the data towards the start, matches point to data
+    that is later in the file. So the data (except the first 0x100 bytes, which are stored raw) is
+    reversed, and compressed like a usual LZ77 stream, with a hash chain match finder.
+    Distances are 3 to 0x2002 bytes, lengths start at 3.
+*/
+#define LAYLA_MIN_DIST 3
+#define LAYLA_MAX_DIST (0x1FFF + LAYLA_MIN_DIST)
+#define LAYLA_MIN_MATCH 3
+#define LAYLA_HASH_BITS 15
+#define LAYLA_WINDOW 0x4000 // Power of two larger than LAYLA_MAX_DIST.
+#define LAYLA_BLOCK 0x100000 // Optimal parsing works on blocks of this size.
+#define LAYLA_OPTIMAL_LENGTHS 64 // Optimal parsing tries every match length up to this, and the longest one.
 
-unsigned char* layla_decomp(unsigned char* data, crilayla_header header){
-    unsigned char *src = new unsigned char[header.compressed_size+256];
-    memcpy(src, data, header.compressed_size+256);
-	unsigned char tbuf[256];
-    unsigned char *dst = new unsigned char[header.decompress_size+256];
-    memset(dst,0,header.decompress_size+256);
-	memcpy(tbuf, (src+header.compressed_size), 256);
-	memcpy(dst, tbuf, 256);
-	llcp_dec(src, header.compressed_size, dst+256, header.decompress_size);
-    delete[] src;
-	return dst;
-}
-
-unsigned int layla_comp(unsigned char* dest, unsigned int* destLen, unsigned char* src, unsigned int srcLen){
-    unsigned int n = srcLen - 1, m = *destLen - 0x1, T = 0, d = 0, p, q, i, j, k;
-    unsigned char* odest = dest;
-    for (; n >= 0x100;)
-    {
-        j = n + 3 + 0x2000;
-        if (j > srcLen) j = srcLen;
-        for (i = n + 3, p = 0; i < j; i++)
-        {
-            for (k = 0; k <= n - 0x100; k++)
-            {
-                if (*(src + n - k) != *(src + i - k)) break;
-            }
-            if (k > p)
-            {
-                q = i - n - 3; p = k;
-            }
+// Match finder limits and parsing strategy of each compression level.
+enum layla_parse{ LAYLA_GREEDY, LAYLA_OPTIMAL };
+struct layla_level{
+    unsigned int chain; // Candidates checked per position.
+    unsigned int nice; // Matches this long are taken right away.
+    layla_parse parse;
+};
+// Every position in the window, this gives the same output as the original exhaustive search.
+static const layla_level LaylaFull = { LAYLA_WINDOW, 0xFFFFFFFF, LAYLA_GREEDY };
+static const layla_level LaylaLevels[] = {
+    { 16, 64, LAYLA_GREEDY },
+    LaylaFull,
+    { 16, 32, LAYLA_OPTIMAL },
+    { 128, 64, LAYLA_OPTIMAL },
+};
+#define LAYLA_LEVELS (sizeof(LaylaLevels) / sizeof(LaylaLevels[0]))
+#define LAYLA_DEFAULT_LEVEL 2
+
+// Writes the bitstream backwards, most significant bits first, as llcp_dec reads it.
+struct layla_writer{
+    unsigned char *dest;
+    size_t pos; // Next free byte, counting down.
+    unsigned long long bits;
+    unsigned int count;
+};
+
+static inline void put_bits(layla_writer &w, unsigned int value, unsigned int n){
+    w.bits = (w.bits << n) | value;
+    w.count += n;
+    while(w.count >= 8){
+        w.count -= 8;
+        w.dest[--w.pos] = (unsigned char)(w.bits >> w.count);
+    }
+    w.bits &= (1ULL << w.count) - 1;
+}
+
+static inline void put_match(layla_writer &w, unsigned int dist, unsigned int len){
+    put_bits(w, 1, 1);
+    put_bits(w, dist - LAYLA_MIN_DIST, 13);
+    len -= LAYLA_MIN_MATCH;
+    if(len < 3){
+        put_bits(w, len, 2);
+        return;
+    }
+    put_bits(w, 3, 2);
+    len -= 3;
+    if(len < 7){
+        put_bits(w, len, 3);
+        return;
+    }
+    put_bits(w, 7, 3);
+    len -= 7;
+    if(len < 31){
+        put_bits(w, len, 5);
+        return;
+    }
+    put_bits(w, 31, 5);
+    len -= 31;
+    for(; len >= 255; len -= 255)
+        put_bits(w, 255, 8);
+    put_bits(w, len, 8);
+}
+
+static inline unsigned int layla_hash(const unsigned char *p){
+    return ((p[0] << 16 | p[1] << 8 | p[2]) * 2654435761u) >> (32 - LAYLA_HASH_BITS);
+}
+
+// Longest match for pos in data[0:len] within the window, returns its length and sets dist.
+static unsigned int layla_find(const unsigned char *data, size_t len, size_t pos, const int *head, const int *prev, const layla_level &level, unsigned int *dist){
+    unsigned int best = 0;
+    size_t limit = len - pos;
+    if(limit < LAYLA_MIN_MATCH)
+        return 0;
+    long long cand = head[layla_hash(data + pos)];
+    for(unsigned int chain = 0; cand >= 0 && chain < level.chain; chain++, cand = prev[cand & (LAYLA_WINDOW - 1)]){
+        size_t d = pos - (size_t)cand;
+        if(d > LAYLA_MAX_DIST)
+            break;
+        if(d < LAYLA_MIN_DIST || data[cand + best] != data[pos + best])
+            continue;
+        size_t n = 0;
+        while(n < limit && data[cand + n] == data[pos + n])
+            n++;
+        if(n > best){
+            best = (unsigned int)n;
+            *dist = (unsigned int)d;
+            if(n >= level.nice || n == limit)
+                break;
         }
-        if (p < 3)
-        {
-            d = (d << 9) | (*(src + n--)); T += 9;
+    }
+    return best >= LAYLA_MIN_MATCH ? best : 0;
+}
+
+// Hash chains of the positions before next.
+struct layla_chains{
+    int *head;
+    int *prev;
+    size_t next;
+};
+
+static inline void layla_insert(const unsigned char *data, size_t len, layla_chains &c, size_t pos){
+    for(; c.next < pos; c.next++){
+        if(c.next + LAYLA_MIN_MATCH > len)
+            continue;
+        unsigned int h = layla_hash(data + c.next);
+        c.prev[c.next & (LAYLA_WINDOW - 1)] = c.head[h];
+        c.head[h] = (int)c.next;
+    }
+}
+
+// Size in bits of a match of the given length.
+static inline unsigned int match_bits(unsigned int len){
+    len -= LAYLA_MIN_MATCH;
+    if(len < 3)
+        return 14 + 2;
+    else if(len < 10)
+        return 14 + 5;
+    else if(len < 41)
+        return 14 + 10;
+    return 14 + 10 + 8 * (1 + (len - 41) / 255);
+}
+
+static void layla_greedy(layla_writer &w, const unsigned char *data, size_t len, layla_chains &c, const layla_level &level){
+    size_t pos = 0;
+    while(pos < len){
+        unsigned int dist = 0;
+        layla_insert(data, len, c, pos);
+        unsigned int match = layla_find(data, len, pos, c.head, c.prev, level, &dist);
+        if(match){
+            put_match(w, dist, match);
+            pos += match;
+        }else{
+            put_bits(w, 0, 1);
+            put_bits(w, data[pos], 8);
+            pos++;
         }
-        else
-        {
-            d = (((d << 1) | 1) << 13) | q; T += 14; n -= p;
-            if (p < 6)
-            {
-                d = (d << 2) | (p - 3); T += 2;
-            }
-            else if (p < 13)
-            {
-                d = (((d << 2) | 3) << 3) | (p - 6); T += 5;
-            }
-            else if (p < 44)
-            {
-                d = (((d << 5) | 0x1f) << 5) | (p - 13); T += 10;
+    }
+}
+
+// Finds the cheapest sequence of literals and matches for each block, the size of every symbol is known exactly.
+// The greedy parse of level 2 is followed with the full search, so it is always one of the candidates
+// and the output is never larger. Other positions use the limits of the level.
+static void layla_optimal(layla_writer &w, const unsigned char *data, size_t len, layla_chains &c, const layla_level &level){
+    unsigned int *price = new unsigned int[LAYLA_BLOCK + 1];
+    unsigned int *lengths = new unsigned int[LAYLA_BLOCK + 1];
+    unsigned short *dists = new unsigned short[LAYLA_BLOCK + 1];
+    size_t greedy = 0; // Next position of the greedy parse, blocks start and end on one.
+    for(size_t start = 0; start < len;){
+        size_t n = len - start < LAYLA_BLOCK ? len - start : LAYLA_BLOCK;
+        bool written = false;
+        for(size_t i = 1; i <= n; i++)
+            price[i] = 0xFFFFFFFF;
+        price[0] = 0;
+        unsigned int match = 0, dist = 0;
+        for(size_t i = 0; i < n; i++){
+            size_t pos = start + i;
+            if(price[i] + 9 < price[i + 1]){
+                price[i + 1] = price[i] + 9;
+                lengths[i + 1] = 1;
             }
-            else
-            {
-                d = ((d << 10) | 0x3ff); T += 10; p -= 44;
-                for (;;)
-                {
-                    for (; T >= 8;)
-                    {
-                        *(dest + m--) = (d >> (T - 8)) & 0xff; T -= 8; d = d & ((1 << T) - 1);
+            layla_insert(data, len, c, pos);
+            // The match of the previous position goes on here, long ones are not searched again.
+            match = match > LAYLA_MIN_MATCH ? match - 1 : 0;
+            unsigned int found = 0, found_dist = 0;
+            bool searched = true;
+            if(pos == greedy){
+                found = layla_find(data, len, pos, c.head, c.prev, LaylaFull, &found_dist);
+                if(found > n - i){
+                    // A greedy match that does not fit ends the block, or is written as it is when the block starts with it.
+                    if(!i){
+                        put_match(w, found_dist, found);
+                        greedy = pos + found;
+                        written = true;
                     }
-                    if (p < 255) break;
-                    d = (d << 8) | 0xff; T += 8; p = p - 0xff;
+                    n = i ? i : found;
+                    break;
+                }
+                greedy = pos + (found ? found : 1);
+            }else if(match < level.nice)
+                found = layla_find(data, start + n, pos, c.head, c.prev, level, &found_dist);
+            else
+                searched = false;
+            if(found > match){
+                match = found;
+                dist = found_dist;
+            }
+            for(unsigned int l = searched || !match ? LAYLA_MIN_MATCH : match; l <= match; l++){
+                if(l > LAYLA_OPTIMAL_LENGTHS && l != match)
+                    l = match;
+                unsigned int cost = price[i] + match_bits(l);
+                if(cost < price[i + l]){
+                    price[i + l] = cost;
+                    lengths[i + l] = l;
+                    dists[i + l] = (unsigned short)dist;
                 }
-                d = (d << 8) | p; T += 8;
             }
         }
-        for (; T >= 8;)
-        {
-            *(dest + m--) = (d >> (T - 8)) & 0xff; T -= 8; d = d & ((1 << T) - 1);
+        if(!written){
+            // Walks back from the end of the block, then writes the symbols in order.
+            size_t count = 0;
+            for(size_t i = n; i > 0; i -= lengths[i])
+                price[count++] = (unsigned int)i;
+            while(count){
+                size_t i = price[--count];
+                unsigned int l = lengths[i];
+                if(l == 1){
+                    put_bits(w, 0, 1);
+                    put_bits(w, data[start + i - 1], 8);
+                }else
+                    put_match(w, dists[i], l);
+            }
         }
+        start += n;
     }
-    if (T != 0)
-    {
-        *(dest + m--) = d << (8 - T);
-    }
-    *(dest + m--) = 0; *(dest + m) = 0;
-    for (;;)
-    {
-        if (((*destLen - m) & 3) == 0) break;
-        *(dest + m--) = 0;
-    }
-    *destLen = *destLen - m; dest += m;
-    unsigned int l[] = { 0x4c495243,0x414c5941,srcLen - 0x100,*destLen };
-    for (j = 0; j < 4; j++)
-    {
-        for (i = 0; i < 4; i++)
-        {
-            *(odest + i + j * 4) = l[j] & 0xff; l[j] >>= 8;
-        }
+    delete[] price;
+    delete[] lengths;
+    delete[] dists;
+}
+
+// Compresses src (srcLen > 0x100) into dest, which must hold layla_bound(srcLen) bytes. Returns the output size.
+static size_t layla_bound(size_t srcLen){
+    return 0x10 + (srcLen - 0x100) / 8 * 9 + 16 + 0x100;
+}
+
+static size_t layla_comp(unsigned char *dest, const unsigned char *src, size_t srcLen, const layla_level &level){
+    size_t len = srcLen - 0x100;
+    unsigned char *data = new unsigned char[len];
+    for(size_t i = 0; i < len; i++)
+        data[i] = src[srcLen - 1 - i];
+    layla_chains chains = { new int[1 << LAYLA_HASH_BITS], new int[LAYLA_WINDOW], 0 };
+    for(unsigned int i = 0; i < (1 << LAYLA_HASH_BITS); i++)
+        chains.head[i] = -1;
+
+    size_t body = layla_bound(srcLen) - 0x10 - 0x100;
+    layla_writer w = { dest + 0x10, body, 0, 0 };
+    if(level.parse == LAYLA_OPTIMAL)
+        layla_optimal(w, data, len, chains, level);
+    else
+        layla_greedy(w, data, len, chains, level);
+    if(w.count)
+        w.dest[--w.pos] = (unsigned char)(w.bits << (8 - w.count));
+    w.dest[--w.pos] = 0;
+    w.dest[--w.pos] = 0;
+    while((body - w.pos) & 3)
+        w.dest[--w.pos] = 0;
+    delete[] data;
+    delete[] chains.head;
+    delete[] chains.prev;
+
+    size_t size = body - w.pos;
+    memmove(dest + 0x10, dest + 0x10 + w.pos, size);
+    memcpy(dest, "CRILAYLA", 8);
+    unsigned int sizes[2] = { (unsigned int)len, (unsigned int)size };
+    for(unsigned int j = 0; j < 2; j++)
+        for(unsigned int i = 0; i < 4; i++)
+            dest[8 + j * 4 + i] = (unsigned char)(sizes[j] >> (i * 8));
+    memcpy(dest + 0x10 + size, src, 0x100);
+    return 0x10 + size + 0x100;
+}
+
+// Reads and checks the header of a CRILAYLA buffer, sets a python error if it is invalid.
+static bool layla_header(const Py_buffer &view, crilayla_header &header){
+    if(view.len < 16 || memcmp(view.buf, "CRILAYLA", 8) != 0){
+        PyErr_SetString(PyExc_ValueError, "Invalid CRILAYLA data.");
+        return false;
     }
-    for (j = 0, odest += 0x10; j < *destLen; j++)
-    {
-        *(odest++) = *(dest + j);
+    memcpy(&header, view.buf, sizeof(header));
+    if((unsigned long long)header.compressed_size + 0x100 > (unsigned long long)view.len - 16){
+        PyErr_SetString(PyExc_ValueError, "Invalid CRILAYLA data.");
+        return false;
     }
-    for (j = 0; j < 0x100; j++)
-    {
-        *(odest++) = *(src + j);
+    return true;
+}
+
+// Decodes into out, which holds decompress_size + 0x100 bytes. Releases the GIL.
+static bool layla_decode(const Py_buffer &view, const crilayla_header &header, unsigned char *out){
+    const unsigned char *data = (const unsigned char *)view.buf;
+    unsigned int done;
+    // The first 0x100 bytes are stored uncompressed after the compressed stream.
+    Py_BEGIN_ALLOW_THREADS
+    memcpy(out, data+16+header.compressed_size, 0x100);
+    done = llcp_dec(data+16, header.compressed_size, out+0x100, header.decompress_size);
+    Py_END_ALLOW_THREADS
+    if(done != header.decompress_size){
+        PyErr_SetString(PyExc_ValueError, "Invalid CRILAYLA data.");
+        return false;
     }
-    *destLen += 0x110;
-    return *destLen;
+    return true;
 }
 
 PyObject* CriLaylaDecompress(PyObject* self, PyObject* d){
-	unsigned char *data = (unsigned char *)PyBytes_AsString(d);
-	crilayla_header header = *(crilayla_header*)data;
-	unsigned char *out = layla_decomp((data+16), header);
-    PyObject *outObj = Py_BuildValue("y#", out, header.decompress_size+256);
-    delete[] out;
-	return outObj;
+    Py_buffer view;
+    crilayla_header header;
+    if(PyObject_GetBuffer(d, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+    if(!layla_header(view, header)){
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+    PyObject *outObj = PyBytes_FromStringAndSize(NULL, (Py_ssize_t)header.decompress_size + 0x100);
+    if(outObj == NULL){
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+    bool ok = layla_decode(view, header, (unsigned char *)PyBytes_AS_STRING(outObj));
+    PyBuffer_Release(&view);
+    if(!ok){
+        Py_DECREF(outObj);
+        return NULL;
+    }
+    return outObj;
+}
+
+// Decompresses into a writable buffer that is at least CriLaylaSize(src) long, returns the decompressed size.
+PyObject* CriLaylaDecompressInto(PyObject* self, PyObject* args){
+    PyObject *src, *dst;
+    Py_buffer view, out;
+    crilayla_header header;
+    if(!PyArg_ParseTuple(args, "OO", &src, &dst))
+        return NULL;
+    if(PyObject_GetBuffer(src, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+    if(!layla_header(view, header)){
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+    if(PyObject_GetBuffer(dst, &out, PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS) < 0){
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+    unsigned long long size = (unsigned long long)header.decompress_size + 0x100;
+    bool ok;
+    if((unsigned long long)out.len < size){
+        PyErr_SetString(PyExc_ValueError, "Output buffer is too small.");
+        ok = false;
+    }else
+        ok = layla_decode(view, header, (unsigned char *)out.buf);
+    PyBuffer_Release(&out);
+    PyBuffer_Release(&view);
+    if(!ok)
+        return NULL;
+    return PyLong_FromUnsignedLongLong(size);
 }
 
-unsigned char* CriLaylaDecompress(unsigned char* d){
-	crilayla_header header = *(crilayla_header*)d;
-	unsigned char *out = layla_decomp((d+16), header);
-	return out;
+// Returns the decompressed size of CRILAYLA data from its header.
+PyObject* CriLaylaSize(PyObject* self, PyObject* d){
+    Py_buffer view;
+    crilayla_header header;
+    if(PyObject_GetBuffer(d, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+    bool ok = layla_header(view, header);
+    PyBuffer_Release(&view);
+    if(!ok)
+        return NULL;
+    return PyLong_FromUnsignedLongLong((unsigned long long)header.decompress_size + 0x100);
 }
 
 PyObject* CriLaylaCompress(PyObject* self, PyObject* args){
-	unsigned char *data;
-	unsigned int data_size;
-    if(!PyArg_ParseTuple(args, "y#", &data, &data_size)){
+    Py_buffer view;
+    unsigned int level = LAYLA_DEFAULT_LEVEL;
+    if(!PyArg_ParseTuple(args, "y*|I", &view, &level)){
+        return NULL;
+    }
+    if(level < 1 || level > LAYLA_LEVELS){
+        PyBuffer_Release(&view);
+        PyErr_Format(PyExc_ValueError, "CRILAYLA compression level must be between 1 and %d.", (int)LAYLA_LEVELS);
+        return NULL;
+    }else if(view.len <= 0x100){
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError, "CRILAYLA compression needs more than 0x100 bytes of data.");
+        return NULL;
+    }else if((unsigned long long)view.len - 0x100 > 0xFFFFFFFF){
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_OverflowError, "CRILAYLA compression supports up to 4GBs of data.");
         return NULL;
     }
-    unsigned char *buf = new unsigned char[data_size];
-    memset(buf, 0, data_size);
-    layla_comp(buf, &data_size, data, data_size);
-	PyObject* bufObj = Py_BuildValue("y#", buf, data_size);
+    size_t srcLen = (size_t)view.len;
+    unsigned char *buf = new unsigned char[layla_bound(srcLen)];
+    size_t size;
+    Py_BEGIN_ALLOW_THREADS
+    size = layla_comp(buf, (const unsigned char *)view.buf, srcLen, LaylaLevels[level - 1]);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&view);
+	PyObject* bufObj = PyBytes_FromStringAndSize((const char *)buf, (Py_ssize_t)size);
     delete[] buf;
     return bufObj;
 }
\ No newline at end of file
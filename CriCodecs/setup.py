@@ -3,5 +3,5 @@ from setuptools import setup, Extension
 setup(
     name="CriCodecs",
     version="0.2.6",
-    ext_modules=[Extension('CriCodecs', ["adx.cpp", "CriCodecs.cpp", "crilayla.cpp", "hca.cpp"])]
+    ext_modules=[Extension('CriCodecs', ["adx.cpp", "CriCodecs.cpp", "crilayla.cpp", "hca.cpp", "utf.cpp"])]
 )
\ No newline at end of file
@@ -0,0 +1,226 @@
+/*
+    @UTF table parser.
+    Parses the header, the column definitions, the rows, the string pool and the binary area
+    of a (possibly encrypted) @UTF table in one go.
+    Row columns are returned as compact native-endian arrays, strings and binary data are left as offsets
+    so that the python side can resolve them through its own string pool.
+
+    UtfCrypt encrypts or decrypts a table (or a part of one) in place on a writable buffer.
+*/
+#define PY_SSIZE_T_CLEAN
+#pragma once
+#include <Python.h>
+#include <string.h>
+
+static const unsigned int UtfTypeSizes[] = { 1, 1, 2, 2, 4, 4, 8, 8, 4, 8, 4, 8 }; // 0xB is an (offset, size) pair.
+
+struct utf_header{
+    unsigned int table_size;
+    unsigned int rows_offset;
+    unsigned int string_offset;
+    unsigned int data_offset;
+    unsigned int table_name;
+    unsigned short num_columns;
+    unsigned short row_length;
+    unsigned int num_rows;
+};
+
+static inline unsigned long long utf_read(const unsigned char* ptr, unsigned int size){
+    unsigned long long value = 0;
+    for(unsigned int i = 0; i < size; i++)
+        value = (value << 8) | ptr[i];
+    return value;
+}
+
+// Copies a big endian value of the given size into a native-endian one.
+static inline void utf_copy(unsigned char* dst, const unsigned char* src, unsigned int size, bool little){
+    if(little){
+        for(unsigned int i = 0; i < size; i++)
+            dst[i] = src[size - 1 - i];
+    }else
+        memcpy(dst, src, size);
+}
+
+// @UTF tables are XORed with the low byte of an LCG, position is the offset of data in the table.
+static void utf_crypt(unsigned char* data, Py_ssize_t length, unsigned long long position = 0){
+    unsigned int m = 0x655f;
+    unsigned int t = 0x4115;
+    for(; position; position >>= 1, t *= t){
+        if(position & 1)
+            m *= t;
+    }
+    t = 0x4115;
+    for(Py_ssize_t i = 0; i < length; i++){
+        data[i] ^= (unsigned char)(m & 0xFF);
+        m *= t;
+    }
+}
+
+static PyObject* utf_scalar(const unsigned char* ptr, unsigned int type){
+    unsigned long long value = utf_read(ptr, UtfTypeSizes[type]);
+    switch(type){
+        case 0x0: return PyLong_FromUnsignedLong((unsigned char)value);
+        case 0x1: return PyLong_FromLong((signed char)value);
+        case 0x2: return PyLong_FromUnsignedLong((unsigned short)value);
+        case 0x3: return PyLong_FromLong((short)value);
+        case 0x4: return PyLong_FromUnsignedLong((unsigned int)value);
+        case 0x5: return PyLong_FromLong((int)value);
+        case 0x6: return PyLong_FromUnsignedLongLong(value);
+        case 0x7: return PyLong_FromLongLong((long long)value);
+        case 0x8: { unsigned int bits = (unsigned int)value; float f; memcpy(&f, &bits, 4); return PyFloat_FromDouble(f); }
+        case 0x9: { double d; memcpy(&d, &value, 8); return PyFloat_FromDouble(d); }
+        case 0xA: return PyLong_FromUnsignedLong((unsigned int)value);
+        default: return Py_BuildValue("(II)", (unsigned int)(value >> 32), (unsigned int)value);
+    }
+}
+
+static PyObject* utf_parse(unsigned char* data, Py_ssize_t length){
+    const unsigned short one = 1;
+    const bool little = *(const unsigned char*)&one == 1;
+    if(length < 0x20){
+        PyErr_SetString(PyExc_ValueError, "Invalid @UTF table.");
+        return NULL;
+    }
+    utf_header header;
+    header.table_size    = (unsigned int)utf_read(data+0x4, 4);
+    header.rows_offset   = (unsigned int)utf_read(data+0x8, 4);
+    header.string_offset = (unsigned int)utf_read(data+0xC, 4);
+    header.data_offset   = (unsigned int)utf_read(data+0x10, 4);
+    header.table_name    = (unsigned int)utf_read(data+0x14, 4);
+    header.num_columns   = (unsigned short)utf_read(data+0x18, 2);
+    header.row_length    = (unsigned short)utf_read(data+0x1A, 2);
+    header.num_rows      = (unsigned int)utf_read(data+0x1C, 4);
+
+    PyObject* columns = PyList_New(header.num_columns);
+    if(columns == NULL)
+        return NULL;
+    unsigned int* offsets = new unsigned int[header.num_columns];
+    unsigned char* types = new unsigned char[header.num_columns];
+    unsigned int row_size = 0;
+    Py_ssize_t pos = 0x20;
+    PyObject* value;
+    for(unsigned int i = 0; i < header.num_columns; i++){
+        if(pos + 5 > length)
+            goto _invalid;
+        unsigned char flag = data[pos];
+        unsigned char stflag = flag >> 4;
+        unsigned char type = flag & 0xF;
+        unsigned int name = (unsigned int)utf_read(data+pos+1, 4);
+        pos += 5;
+        if(type > 0xB){
+            PyErr_SetString(PyExc_Exception, "Unkown data type.");
+            goto _error;
+        }
+        types[i] = flag;
+        if(stflag == 0x1){
+            Py_INCREF(Py_None);
+            value = Py_None;
+        }else if(stflag == 0x3){
+            if(pos + UtfTypeSizes[type] > length)
+                goto _invalid;
+            value = utf_scalar(data+pos, type);
+            pos += UtfTypeSizes[type];
+        }else if(stflag == 0x5){
+            offsets[i] = row_size;
+            row_size += UtfTypeSizes[type];
+            value = NULL; // Filled once all columns are known.
+        }else if(stflag == 0x7){
+            PyErr_SetString(PyExc_NotImplementedError, "Unsupported 0x70 storage flag.");
+            goto _error;
+        }else{
+            PyErr_SetString(PyExc_Exception, "Unknown storage flag.");
+            goto _error;
+        }
+        PyList_SET_ITEM(columns, i, Py_BuildValue("(BIN)", flag, name, value ? value : (Py_INCREF(Py_None), Py_None)));
+    }
+
+    {
+        unsigned int stride = header.row_length > row_size ? header.row_length : row_size;
+        unsigned long long rows_start = (unsigned long long)header.rows_offset + 8;
+        if(row_size && rows_start + (unsigned long long)stride * header.num_rows > (unsigned long long)length)
+            goto _invalid;
+        for(unsigned int i = 0; i < header.num_columns; i++){
+            if((types[i] >> 4) != 0x5)
+                continue;
+            unsigned int type = types[i] & 0xF;
+            unsigned int size = UtfTypeSizes[type];
+            PyObject* array = PyBytes_FromStringAndSize(NULL, (Py_ssize_t)size * header.num_rows);
+            if(array == NULL)
+                goto _error;
+            unsigned char* out = (unsigned char*)PyBytes_AS_STRING(array);
+            const unsigned char* row = data + rows_start + offsets[i];
+            // Pairs are kept as two native uints, offset first.
+            unsigned int part = type == 0xB ? 4 : size;
+            for(unsigned int j = 0; j < header.num_rows; j++, row += stride, out += size){
+                utf_copy(out, row, part, little);
+                if(type == 0xB)
+                    utf_copy(out+4, row+4, 4, little);
+            }
+            PyObject* column = PyList_GET_ITEM(columns, i);
+            PyObject* item = PyTuple_GET_ITEM(column, 2);
+            PyTuple_SET_ITEM(column, 2, array);
+            Py_DECREF(item);
+        }
+    }
+    delete[] offsets;
+    delete[] types;
+    return columns;
+
+_invalid:
+    PyErr_SetString(PyExc_ValueError, "Invalid @UTF table.");
+_error:
+    delete[] offsets;
+    delete[] types;
+    Py_DECREF(columns);
+    return NULL;
+}
+
+static PyObject* UtfParse(PyObject* self, PyObject* args){
+    Py_buffer view;
+    if(PyObject_GetBuffer(args, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+    unsigned char* data = (unsigned char*)view.buf;
+    Py_ssize_t length = view.len;
+    PyObject* decrypted = Py_None;
+    if(length >= 4 && memcmp(data, "\x1F\x9E\xF3\xF5", 4) == 0){
+        decrypted = PyBytes_FromStringAndSize((const char*)data, length);
+        PyBuffer_Release(&view);
+        if(decrypted == NULL)
+            return NULL;
+        data = (unsigned char*)PyBytes_AS_STRING(decrypted);
+        utf_crypt(data, length);
+        if(memcmp(data, "@UTF", 4) != 0){
+            Py_DECREF(decrypted);
+            PyErr_SetString(PyExc_Exception, "Decryption error.");
+            return NULL;
+        }
+    }else if(length < 4 || memcmp(data, "@UTF", 4) != 0){
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError, "UTF chunk is not present.");
+        return NULL;
+    }else
+        Py_INCREF(decrypted);
+    PyObject* columns = utf_parse(data, length);
+    if(decrypted == Py_None)
+        PyBuffer_Release(&view);
+    if(columns == NULL){
+        Py_DECREF(decrypted);
+        return NULL;
+    }
+    return Py_BuildValue("(NN)", decrypted, columns);
+}
+
+static PyObject* UtfCrypt(PyObject* self, PyObject* args){
+    Py_buffer view;
+    PyObject* buf;
+    unsigned long long position = 0;
+    if(!PyArg_ParseTuple(args, "O|K", &buf, &position))
+        return NULL;
+    if(PyObject_GetBuffer(buf, &view, PyBUF_WRITABLE | PyBUF_SIMPLE) < 0)
+        return NULL;
+    Py_BEGIN_ALLOW_THREADS
+    utf_crypt((unsigned char*)view.buf, view.len, position);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&view);
+    Py_RETURN_NONE;
+}
@@ -1,9 +1,9 @@
 from .adx import ADX
 from .hca import HCA
 from .chunk import *
-from .cpk import CPK, CPKBuilder
+from .cpk import CPK, CPKBuilder, CPKPatcher, CPKCache
 from .usm import USM, USMBuilder
-from .utf import UTF, UTFBuilder
+from .utf import UTF, UTFBuilder, UTFPatcher
 from .acb import ACB, ACBBuilder
 from .awb import AWB, AWBBuilder
 from .ivf import IVF
\ No newline at end of file
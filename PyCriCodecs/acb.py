@@ -14,20 +14,21 @@ class ACB(UTF):
     awb: AWB
 
     def __init__(self, filename) -> None:
-        self.payload = UTF(filename).get_payload()
+        pools = dict()
+        self.payload = UTF(filename, pools=pools).get_payload()
         self.filename = filename
-        self.acbparse(self.payload)
+        self.acbparse(self.payload, pools)
         # TODO check on ACB version.
     
-    def acbparse(self, payload: list) -> None:
+    def acbparse(self, payload: list, pools: dict = None) -> None:
         """ Recursively parse the payload. """
         for dict in range(len(payload)):
             for k, v in payload[dict].items():
                 if v[0] == UTFTypeValues.bytes:
                     if v[1].startswith(UTFType.UTF.value): #or v[1].startswith(UTFType.EUTF.value): # ACB's never gets encrypted? 
-                        par = UTF(v[1]).get_payload()
+                        par = UTF(v[1], pools=pools).get_payload()
                         payload[dict][k] = par
-                        self.acbparse(par)
+                        self.acbparse(par, pools)
         self.load_awb()
     
     def load_awb(self) -> None:
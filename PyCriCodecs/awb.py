@@ -4,6 +4,7 @@ from typing import BinaryIO
 from struct import iter_unpack, pack
 from .chunk import *
 from .hca import HCA
+from .fileio import copy_range
 
 # for AFS2 only.
 class AWB:
@@ -53,32 +54,38 @@ class AWB:
 
     def extract(self, decode=False, key=0):
         """ Extracts the files. """
-        count = 0
-        for i in self.getfiles():
-            # Apparently AWB's can have many types of files, focusing on HCA's here though. So TODO.
-            if self.filename:
-                if i.startswith(HCAType.HCA.value) or i.startswith(HCAType.EHCA.value):
+        if self.filename:
+            # Files are copied straight from the archive file, only HCA's to decode are read.
+            for count in range(len(self.ofs) - 1):
+                offset = self.headersize if count == 0 else self.ofs[count]
+                size = self.ofs[count+1] - self.ofs[count]
+                self.stream.seek(offset, 0)
+                magic = self.stream.read(4)
+                # Apparently AWB's can have many types of files, focusing on HCA's here though. So TODO.
+                if magic.startswith(HCAType.HCA.value) or magic.startswith(HCAType.EHCA.value):
                     if decode:
                         filename = self.filename.rsplit(".", 1)[0] + "_" + str(count) + ".wav"
-                    else:
-                        filename = self.filename.rsplit(".", 1)[0] + "_" + str(count) + ".hca"
+                        self.stream.seek(offset, 0)
+                        open(filename, "wb").write(HCA(self.stream.read(size), key=key, subkey=self.subkey).decode())
+                        continue
+                    filename = self.filename.rsplit(".", 1)[0] + "_" + str(count) + ".hca"
                 else:
                     # Probably ADX.
                     filename = self.filename.rsplit(".", 1)[0] + "_" + str(count) + ".dat"
-                    open(filename, "wb").write(i)
-                    count += 1
-                    continue
-                open(filename, "wb").write(i if not decode else HCA(i, key=key, subkey=self.subkey).decode())
-                count += 1
-            else:
-                if i.startswith(HCAType.HCA.value) or i.startswith(HCAType.EHCA.value):
-                    if decode:
-                        open(str(count)+".wav", "wb").write(HCA(i, key=key, subkey=self.subkey).decode())
-                    else:
-                        open(str(count)+".hca", "wb").write(i)
+                with open(filename, "wb", buffering=0) as out:
+                    copy_range(self.stream, offset, size, out)
+            self.stream.seek(self.headersize, 0)
+            return
+        count = 0
+        for i in self.getfiles():
+            if i.startswith(HCAType.HCA.value) or i.startswith(HCAType.EHCA.value):
+                if decode:
+                    open(str(count)+".wav", "wb").write(HCA(i, key=key, subkey=self.subkey).decode())
                 else:
-                    open(str(count)+".dat", "wb").write(i)
-                count += 1
+                    open(str(count)+".hca", "wb").write(i)
+            else:
+                open(str(count)+".dat", "wb").write(i)
+            count += 1
 
     def getfiles(self):
         """ Generator function to yield data from an AWB. """
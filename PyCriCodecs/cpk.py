@@ -1,10 +1,60 @@
 from typing import BinaryIO
 from io import BytesIO, FileIO
 import os
+import mmap
+import threading
+import hashlib
+import time
+import zlib
+from collections import deque
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from .chunk import *
-from .utf import UTF, UTFBuilder
+from .utf import UTF, UTFBuilder, UTFPatcher
+from .fileio import write_padding, copy_range, copy_file
 import CriCodecs
 
+def compress_level(compress) -> int:
+    """ Returns the CriLaylaCompress level of a compress argument, True is the default level and False is none. """
+    if compress is True:
+        return 2
+    elif compress is False or compress is None or compress == 0:
+        return False
+    elif type(compress) != int or not 1 <= compress <= 4:
+        raise ValueError("compress must be True, False or a CriLaylaCompress level from 1 to 4.")
+    return compress
+
+def toc_key(row: dict) -> str:
+    """ Sort key of a TOC row, the TOC is sorted by path the same way CPKBuilder sorts directories. """
+    return (row["DirName"][1] + "/" + row["FileName"][1]).replace("_", "~").lower()
+
+def file_crc(path: str) -> int:
+    crc = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(0x100000), b""):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+def same_contents(path: str, data) -> bool:
+    """ Compares a file with data without reading it whole. """
+    data = memoryview(data)
+    with open(path, "rb") as f:
+        for i in range(0, len(data), 0x100000):
+            if f.read(0x100000) != data[i:i+0x100000]:
+                return False
+        return not f.read(1)
+
+def make_chunk(magic: bytes, data: bytearray, encflag: int) -> bytearray:
+    """ Prepends the chunk header to a table and pads it to 0x800. """
+    data = bytearray(CPKChunkHeader.pack(magic, encflag, len(data), 0)) + data
+    return data.ljust(len(data) + (0x800 - len(data) % 0x800), b'\x00')
+
+def chunk_size(table: UTFBuilder) -> int:
+    """ Size of a table chunk once its header and padding are added, without building the table. """
+    table.layout()
+    size = CPKChunkHeader.size + table.data_offset + 0x8
+    return size + (0x800 - size % 0x800)
+
 class TOC():
     __slots__ = ["magic", "encflag", "packet_size", "unk0C", "stream", "table"]
     magic: bytes
@@ -13,17 +63,37 @@ class TOC():
     unk0C: int
     stream: BinaryIO
     table: dict
-    def __init__(self, stream: bytes) -> None:
+    def __init__(self, stream: bytes, pools: dict = None) -> None:
         self.stream = BytesIO(stream)
         self.magic, self.encflag, self.packet_size, self.unk0C = CPKChunkHeader.unpack(
             self.stream.read(CPKChunkHeader.size)
         )
         if self.magic not in [header.value for header in CPKChunkHeaderType]:
             raise ValueError(f"{self.magic} header not supported.")
-        self.table = UTF(self.stream.read()).table
+        self.table = UTF(self.stream.read(), pools=pools).table
+
+class CPKEntry:
+    """ A file inside a CPK, offset is absolute in the archive. """
+    __slots__ = ["id", "dirname", "filename", "offset", "size", "extract_size", "crc"]
+    id: int
+    dirname: str
+    filename: str
+    offset: int
+    size: int
+    extract_size: int
+    crc: int # CRC32 of the extracted file, when the archive has EnableFileCrc.
+    def __init__(self, id: int, dirname: str, filename: str, offset: int, size: int, extract_size: int, crc: int = None) -> None:
+        self.id = id
+        self.dirname = dirname
+        self.filename = filename
+        self.offset = offset
+        self.size = size
+        self.extract_size = extract_size
+        self.crc = crc
 
 class CPK:
-    __slots__ = ["magic", "encflag", "packet_size", "unk0C", "stream", "tables", "filename"]
+    __slots__ = ["magic", "encflag", "packet_size", "unk0C", "stream", "tables", "filename",
+                "files", "entries", "names", "ids", "data"]
     magic: bytes
     encflag: int
     packet_size: int
@@ -31,187 +101,406 @@ class CPK:
     stream: BinaryIO
     tables: dict
     filename: str
-    def __init__(self, filename) -> None:
+    files: list # Entries in archive order.
+    entries: dict # (DirName, FileName) to entry.
+    names: dict # FileName to the first entry with it.
+    ids: dict # ID to entry.
+    data: memoryview # Whole archive, when it is mapped or given in memory.
+    def __init__(self, filename, mapped: bool = False) -> None:
+        # With mapped, the archive file is memory mapped and stored files are served as views into it.
         if type(filename) == str:
             self.filename = filename
             self.stream = FileIO(filename)
+            if mapped:
+                self.data = memoryview(mmap.mmap(self.stream.fileno(), 0, access=mmap.ACCESS_READ))
+            else:
+                self.data = None
         else:
             self.stream = BytesIO(filename)
             self.filename = ''
+            self.data = memoryview(filename).cast("B").toreadonly()
         self.magic, self.encflag, self.packet_size, self.unk0C = CPKChunkHeader.unpack(
             self.stream.read(CPKChunkHeader.size)
         )
         if self.magic != CPKChunkHeaderType.CPK.value:
             raise ValueError("Invalid CPK file.")
-        self.tables = dict(CPK = UTF(self.stream.read(0x800-CPKChunkHeader.size)).table)
-        self.checkTocs()
+        pools = dict()
+        self.tables = dict(CPK = UTF(self.stream.read(0x800-CPKChunkHeader.size), pools=pools).table)
+        self.checkTocs(pools)
+        self.build_index()
     
-    def checkTocs(self) -> None:
+    def checkTocs(self, pools: dict = None) -> None:
         for key, value in self.tables["CPK"].items():
             if key == "TocOffset":
                 if value[0]:
                     self.stream.seek(value[0], 0)
-                    self.tables["TOC"] = TOC(self.stream.read(self.tables['CPK']["TocSize"][0])).table
+                    self.tables["TOC"] = TOC(self.stream.read(self.tables['CPK']["TocSize"][0]), pools).table
             elif key == "ItocOffset":
                 if value[0]:
                     self.stream.seek(value[0], 0)
-                    self.tables["ITOC"] = TOC(self.stream.read(self.tables['CPK']["ItocSize"][0])).table
+                    self.tables["ITOC"] = TOC(self.stream.read(self.tables['CPK']["ItocSize"][0]), pools).table
                     if "DataL" in self.tables["ITOC"]:
-                        self.tables["ITOC"]['DataL'][0] = UTF(self.tables["ITOC"]['DataL'][0]).table
+                        self.tables["ITOC"]['DataL'][0] = UTF(self.tables["ITOC"]['DataL'][0], pools=pools).table
                     if "DataH" in self.tables["ITOC"]:
-                        self.tables["ITOC"]['DataH'][0] = UTF(self.tables["ITOC"]['DataH'][0]).table
+                        self.tables["ITOC"]['DataH'][0] = UTF(self.tables["ITOC"]['DataH'][0], pools=pools).table
             elif key == "HtocOffset":
                 if value[0]:
                     self.stream.seek(value[0], 0)
-                    self.tables["HTOC"] = TOC(self.stream.read(self.tables['CPK']["HtocSize"][0])).table
+                    self.tables["HTOC"] = TOC(self.stream.read(self.tables['CPK']["HtocSize"][0]), pools).table
             elif key == "GtocOffset":
                 if value[0]:
                     self.stream.seek(value[0], 0)
-                    self.tables["GTOC"] = TOC(self.stream.read(self.tables['CPK']["GtocSize"][0])).table
+                    self.tables["GTOC"] = TOC(self.stream.read(self.tables['CPK']["GtocSize"][0]), pools).table
                     if "AttrData" in self.tables["GTOC"]:
-                        self.tables["GTOC"]['AttrData'][0] = UTF(self.tables["GTOC"]['AttrData'][0]).table
+                        self.tables["GTOC"]['AttrData'][0] = UTF(self.tables["GTOC"]['AttrData'][0], pools=pools).table
                     if "Fdata" in self.tables["GTOC"]:
-                        self.tables["GTOC"]['Fdata'][0] = UTF(self.tables["GTOC"]['Fdata'][0]).table
+                        self.tables["GTOC"]['Fdata'][0] = UTF(self.tables["GTOC"]['Fdata'][0], pools=pools).table
                     if "Gdata" in self.tables["GTOC"]:
-                        self.tables["GTOC"]['Gdata'][0] = UTF(self.tables["GTOC"]['Gdata'][0]).table
+                        self.tables["GTOC"]['Gdata'][0] = UTF(self.tables["GTOC"]['Gdata'][0], pools=pools).table
             elif key == "HgtocOffset":
                 if value[0]:
                     self.stream.seek(value[0], 0)
-                    self.tables["HGTOC"] = TOC(self.stream.read(self.tables['CPK']["HgtocSize"][0])).table
+                    self.tables["HGTOC"] = TOC(self.stream.read(self.tables['CPK']["HgtocSize"][0]), pools).table
             elif key == "EtocOffset":
                 if value[0]:
                     self.stream.seek(value[0], 0)
-                    self.tables["ETOC"] = TOC(self.stream.read(self.tables['CPK']["EtocSize"][0])).table
+                    self.tables["ETOC"] = TOC(self.stream.read(self.tables['CPK']["EtocSize"][0]), pools).table
     
-    def extract(self):
+    def build_index(self) -> None:
+        """ Indexes every file by path, name and ID, so that lookups do not scan the tables. """
+        self.files = []
+        self.entries = dict()
+        self.names = dict()
+        self.ids = dict()
+        # Columns with the same value in every row are stored once, numbers as a 1-tuple.
+        def column(table: dict, name: str, i: int):
+            value = table[name][i % len(table[name])]
+            return value[0] if type(value) == tuple else value
         if "TOC" in self.tables:
             toctable = self.tables['TOC']
-            rel_off = 0x800
+            rel_off = self.tables["CPK"]["TocOffset"][0]
+            crc = "CRC" in toctable and self.tables["CPK"].get("EnableFileCrc", [0])[0]
             for i in range(len(toctable['FileName'])):
-                if toctable["DirName"][i%len(toctable["DirName"])] == '':
-                    dirname = self.filename.rsplit(".")[0]
+                entry = CPKEntry(
+                    column(toctable, "ID", i) if "ID" in toctable else i,
+                    column(toctable, "DirName", i),
+                    toctable['FileName'][i],
+                    rel_off+column(toctable, "FileOffset", i),
+                    column(toctable, "FileSize", i),
+                    column(toctable, "ExtractSize", i),
+                    column(toctable, "CRC", i) if crc else None
+                )
+                self.files.append(entry)
+                self.entries.setdefault((entry.dirname, entry.filename), entry)
+                self.names.setdefault(entry.filename, entry)
+                self.ids.setdefault(entry.id, entry)
+            if "ITOC" in self.tables and "TocIndex" in self.tables["ITOC"]:
+                itoctable = self.tables["ITOC"]
+                for i in range(len(itoctable['ID'])):
+                    self.ids[itoctable['ID'][i]] = self.files[column(itoctable, "TocIndex", i)]
+        elif "ITOC" in self.tables:
+            # Tables with no files of a size class still hold one dummy row, FilesL and FilesH are the real counts.
+            itoctable = self.tables["ITOC"]
+            for table, count in [(itoctable['DataL'][0], itoctable['FilesL'][0]), (itoctable['DataH'][0], itoctable['FilesH'][0])]:
+                for i in range(count):
+                    entry = CPKEntry(
+                        column(table, "ID", i),
+                        "",
+                        str(column(table, "ID", i)),
+                        None,
+                        column(table, "FileSize", i),
+                        column(table, "ExtractSize", i)
+                    )
+                    self.ids[entry.id] = entry
+            self.files = [self.ids[i] for i in sorted(self.ids)]
+            # ITOC files are laid out sorted by ID, each aligned, so the offsets are a prefix sum of the aligned sizes.
+            align = self.tables['CPK']["Align"][0]
+            offset = self.tables["CPK"]["ContentOffset"][0]
+            for entry in self.files:
+                entry.offset = offset
+                offset += entry.size
+                if entry.size % align != 0:
+                    offset += (align - entry.size % align)
+                self.entries[(entry.dirname, entry.filename)] = entry
+                self.names[entry.filename] = entry
+
+    def raw_entry(self, entry: CPKEntry):
+        """ Returns the stored bytes of a file, as a view when the archive is mapped or in memory. """
+        if self.data is not None:
+            return self.data[entry.offset:entry.offset+entry.size]
+        self.stream.seek(entry.offset, 0)
+        return self.stream.read(entry.size)
+
+    def read_entry(self, entry: CPKEntry) -> bytes:
+        """ Reads a file, decompressing it if needed. """
+        data = self.raw_entry(entry)
+        if entry.extract_size > entry.size:
+            return CriCodecs.CriLaylaDecompress(data)
+        return bytes(data)
+
+    def view_entry(self, entry: CPKEntry) -> memoryview:
+        """ Returns a read-only view of a file, stored files are not copied when the archive is mapped or in memory. """
+        if self.data is None or entry.extract_size > entry.size:
+            return memoryview(self.read_entry(entry)).toreadonly()
+        return self.data[entry.offset:entry.offset+entry.size]
+
+    def copy_entry(self, entry: CPKEntry, path: str) -> bool:
+        """ Copies a stored file from the archive file straight into path, returns False if it has to be read instead. """
+        if not self.filename or entry.extract_size > entry.size:
+            return False
+        with open(path, "wb", buffering=0) as out:
+            copy_range(self.stream, entry.offset, entry.size, out)
+        return True
+
+    def extract_dir(self) -> str:
+        """ Returns the directory files are extracted to, the archive path without its extension,
+        or "" (the current directory) for an archive given in memory. """
+        return os.path.splitext(self.filename)[0] if self.filename else ""
+
+    def extract_paths(self) -> list:
+        """ Returns the (entry, output path) of every file, creating the output directories. """
+        paths = []
+        root = self.extract_dir()
+        if "TOC" in self.tables:
+            for i, entry in enumerate(self.files):
+                if entry.dirname == '':
+                    dirname = root
                 else:
-                    dirname = os.path.join(self.filename.rsplit(".")[0], toctable["DirName"][i%len(toctable["DirName"])])
-                os.makedirs(dirname, exist_ok=True)
-                filename = toctable['FileName'][i]
+                    dirname = os.path.join(root, entry.dirname)
+                if dirname:
+                    os.makedirs(dirname, exist_ok=True)
+                filename = entry.filename
                 if len(filename) >= 255:
                     filename = filename[:250] + "_" + str(i) # 250 because i might be 4 digits long.
-                if toctable['ExtractSize'][i] > toctable['FileSize'][i]:
-                    self.stream.seek(rel_off+toctable["FileOffset"][i], 0)
-                    comp_data = self.stream.read(toctable['FileSize'][i])
-                    open(os.path.join(dirname, filename), "wb").write(CriCodecs.CriLaylaDecompress(comp_data))
-                else:
-                    self.stream.seek(rel_off+toctable["FileOffset"][i], 0)
-                    open(os.path.join(dirname, filename), "wb").write(self.stream.read(toctable['FileSize'][i]))
+                paths.append((entry, os.path.join(dirname, filename)))
         elif "ITOC" in self.tables:
-            toctableL = self.tables["ITOC"]['DataL'][0]
-            toctableH = self.tables["ITOC"]['DataH'][0]
-            align = self.tables['CPK']["Align"][0]
-            offset = self.tables["CPK"]["ContentOffset"][0]
-            files = self.tables["CPK"]["Files"][0]
-            self.stream.seek(offset, 0)
-            if self.filename:
-                dirname = self.filename.rsplit(".")[0]
-                os.makedirs(dirname, exist_ok=True)
+            if root:
+                os.makedirs(root, exist_ok=True)
+            for entry in self.files:
+                paths.append((entry, os.path.join(root, entry.filename)))
+        return paths
+
+    def plan_reads(self, entries: list, readahead: int = 0x100000) -> list:
+        """ Sorts entries by offset and merges neighbours into reads of at most readahead bytes.
+        Returns a list of [start, end, entries], a larger file is read on its own. """
+        reads = []
+        for entry in sorted(entries, key=lambda x: x.offset):
+            end = entry.offset + entry.size
+            if reads and end - reads[-1][0] <= readahead:
+                # Files sharing data can overlap.
+                reads[-1][1] = max(reads[-1][1], end)
+                reads[-1][2].append(entry)
             else:
-                dirname = ""
-            for i in sorted(toctableH['ID']+toctableL['ID']):
-                if i in toctableH['ID']:
-                    idx = toctableH['ID'].index(i)
-                    if toctableH['ExtractSize'][idx] > toctableH['FileSize'][idx]:
-                        comp_data = self.stream.read(toctableH['FileSize'][idx])
-                        open(os.path.join(dirname, str(i)), "wb").write(CriCodecs.CriLaylaDecompress(comp_data))
-                    else:
-                        open(os.path.join(dirname, str(i)), "wb").write(self.stream.read(toctableH['FileSize'][idx]))
-                    if toctableH['FileSize'][idx] % align != 0:
-                        seek_size = (align - toctableH['FileSize'][idx] % align)
-                        self.stream.seek(seek_size, 1)
-                elif i in toctableL['ID']:
-                    idx = toctableL['ID'].index(i)
-                    if toctableL['ExtractSize'][idx] > toctableL['FileSize'][idx]:
-                        comp_data = self.stream.read(toctableL['FileSize'][idx])
-                        open(os.path.join(dirname, str(i)), "wb").write(CriCodecs.CriLaylaDecompress(comp_data))
-                    else:
-                        open(os.path.join(dirname, str(i)), "wb").write(self.stream.read(toctableL['FileSize'][idx]))
-                    if toctableL['FileSize'][idx] % align != 0:
-                        seek_size = (align - toctableL['FileSize'][idx] % align)
-                        self.stream.seek(seek_size, 1)
+                reads.append([entry.offset, end, [entry]])
+        return reads
+
+    def read_range(self, start: int, end: int) -> memoryview:
+        if self.data is not None:
+            return self.data[start:end]
+        self.stream.seek(start, 0)
+        return memoryview(self.stream.read(end - start))
+
+    def read_batch(self, entries: list = None, readahead: int = 0x100000, skip = None):
+        """ Generator of the (entry, stored data) of the given entries, or of all of them, in archive order.
+        Neighbouring files are read together, so the archive is read in one pass.
+        A file read on its own is left out without being read when skip(entry) returns True. """
+        for start, end, group in self.plan_reads(self.files if entries is None else entries, readahead):
+            if skip is not None and len(group) == 1 and skip(group[0]):
+                continue
+            data = self.read_range(start, end)
+            for entry in group:
+                yield entry, data[entry.offset-start:entry.offset-start+entry.size]
+
+    def extract(self, workers: int = 1, readahead: int = 0x100000, incremental: bool = False, delete: bool = False):
+        """ Extracts all files, with workers above 1 files are decompressed and written on a thread pool.
+        Files are read in archive order, neighbouring files up to readahead bytes in one read.
+        With incremental, files already on disk with the same contents are not written again,
+        with delete, files in the output directory that are not in the archive are removed. """
+        if delete:
+            # Checked before anything is written.
+            self.delete_root()
+        paths = self.extract_paths()
+        # Files with the same path would overwrite each other, only the last one is written.
+        targets = {entry: path for path, entry in {path: entry for entry, path in paths}.items()}
+        # Files whose size matches are checked by their CRC when the archive has them, or compared once read.
+        compare = set()
+        if incremental:
+            for entry, path in list(targets.items()):
+                if not os.path.isfile(path) or os.path.getsize(path) != entry.extract_size:
+                    continue
+                if entry.crc is None:
+                    compare.add(entry)
+                elif file_crc(path) == entry.crc:
+                    del targets[entry]
+        # Compressed files are decompressed into a scratch buffer that is reused, one per thread.
+        scratch = threading.local()
+        def write(entry: CPKEntry, data, path: str) -> None:
+            if entry.extract_size > entry.size:
+                size = CriCodecs.CriLaylaSize(data)
+                if len(getattr(scratch, "buffer", b"")) < size:
+                    scratch.buffer = bytearray(size)
+                data = memoryview(scratch.buffer)[:CriCodecs.CriLaylaDecompressInto(data, scratch.buffer)]
+            if entry in compare and same_contents(path, data):
+                return
+            open(path, "wb").write(data)
+        pool = ThreadPoolExecutor(workers) if workers > 1 else None
+        pending = deque()
+        try:
+            # A stored file read on its own is copied by the kernel instead.
+            copied = lambda entry: entry not in compare and self.copy_entry(entry, targets[entry])
+            for entry, view in self.read_batch(list(targets), readahead, copied):
+                if pool is None:
+                    write(entry, view, targets[entry])
+                    continue
+                # At most a few files per worker are kept in memory.
+                pending.append(pool.submit(write, entry, view, targets[entry]))
+                if len(pending) >= workers * 4:
+                    pending.popleft().result()
+            for future in pending:
+                future.result()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        if delete:
+            self.delete_stale([path for _, path in paths])
+
+    def delete_root(self) -> str:
+        """ Returns the absolute output directory stale files are deleted from,
+        raises if it is the current directory or one holding it, where unrelated files would be removed. """
+        if not self.filename:
+            raise ValueError("Deleting stale files needs a CPK opened from a file.")
+        root = os.path.realpath(self.extract_dir())
+        if os.path.commonpath([root, os.path.realpath(os.getcwd())]) == root:
+            raise ValueError("Refusing to delete stale files in " + root + ", it holds the current directory.")
+        return root
+
+    def delete_stale(self, paths: list) -> None:
+        """ Removes files and empty directories in the output directory that are not in the given paths. """
+        root = self.delete_root()
+        keep = set(os.path.realpath(path) for path in paths)
+        for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if os.path.realpath(path) not in keep:
+                    os.remove(path)
+            if dirpath != root and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+
+    def find(self, filename) -> CPKEntry:
+        """ Returns the entry of a "DirName/FileName" path, a FileName, or an ID. """
+        if type(filename) == int:
+            entry = self.ids.get(filename)
+        elif filename in self.names:
+            entry = self.names[filename]
+        else:
+            entry = self.entries.get(tuple(filename.rsplit("/", 1))) if "/" in filename else None
+        if entry is None:
+            raise ValueError("Given filename does not exist inside the provided CPK.")
+        return entry
                 
+    def open(self, filename) -> memoryview:
+        """ Returns a read-only memoryview of a file, given its path, name or ID. """
+        return self.view_entry(self.find(filename))
+
+    def read(self, filename) -> bytes:
+        """ Returns the (decompressed) contents of a file, given its path, name or ID. """
+        return self.read_entry(self.find(filename))
+
     def extract_file(self, filename):
         if "TOC" in self.tables:
-            toctable = self.tables['TOC']
-            rel_off = 0x800
-            if toctable["DirName"][0] == '':
-                dirname = self.filename.rsplit(".")[0]
+            entry = self.find(filename)
+            if entry.dirname == '':
+                dirname = self.extract_dir()
             else:
-                dirname = os.path.join(self.filename.rsplit(".")[0], toctable["DirName"][0])
+                dirname = os.path.join(self.extract_dir(), entry.dirname)
             if self.filename:
                 os.makedirs(dirname, exist_ok=True)
-            if filename not in toctable['FileName']:
-                raise ValueError("Given filename does not exist inside the provided CPK.")
-            idx = toctable['FileName'].index(filename)
-            offset = rel_off+toctable["FileOffset"][idx]
-            size = toctable['FileSize'][idx]
-            self.stream.seek(offset, 0)
-            open(os.path.join(dirname, filename), "wb").write(self.stream.read(size))
+            path = os.path.join(dirname, entry.filename)
+            if not self.copy_entry(entry, path):
+                open(path, "wb").write(self.view_entry(entry))
         elif "ITOC" in self.tables:
-            filename = int(filename)
-            toctableL = self.tables["ITOC"]['DataL'][0]
-            toctableH = self.tables["ITOC"]['DataH'][0]
-            alignmentsize = self.tables["CPK"]["Align"][0]
-            files = self.tables["CPK"]["Files"][0]
-            offset = self.tables["CPK"]["ContentOffset"][0]
-            if filename in toctableL['ID']:
-                idxg = toctableL['ID'].index(filename)
-            elif filename in toctableH['ID']:
-                idxg = toctableH['ID'].index(filename)
-            else:
-                raise ValueError("Given ID does not exist in the given CPK.")
-            self.stream.seek(offset, 0)
-            realOffset = offset
-            for i in sorted(toctableH['ID']+toctableL['ID']):
-                if i != filename:
-                    if i in toctableH["ID"]:
-                        idx = toctableH['ID'].index(i)
-                        realOffset += toctableH["FileSize"][idx]
-                        if toctableH["FileSize"][idx] % alignmentsize != 0:
-                            realOffset += (alignmentsize - toctableH["FileSize"][idx] % alignmentsize)
-                    elif i in toctableL["ID"]:
-                        idx = toctableL['ID'].index(i)
-                        realOffset += toctableH["FileSize"][idx]
-                        if toctableL["FileSize"][idx] % alignmentsize != 0:
-                            realOffset += (alignmentsize - toctableL["FileSize"][idx] % alignmentsize)
-                else:
-                    if self.filename:
-                        dirname = self.filename.rsplit(".")[0]
-                        os.makedirs(dirname)
-                    else:
-                        dirname = ""
-                    if filename in toctableH["ID"]:
-                        extractsz = toctableH['ExtractSize'][idxg]
-                        flsize = toctableH['FileSize'][idxg]
-                        if extractsz > flsize:
-                            self.stream.seek(realOffset)
-                            comp_data = self.stream.read(toctableH['FileSize'][idxg])
-                            open(os.path.join(dirname, str(filename)), "wb").write(CriCodecs.CriLaylaDecompress(comp_data))
-                        else:
-                            open(os.path.join(dirname, str(filename)), "wb").write(self.stream.read(toctableH['FileSize'][idxg]))
+            entry = self.find(int(filename))
+            dirname = self.extract_dir()
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            path = os.path.join(dirname, entry.filename)
+            if not self.copy_entry(entry, path):
+                open(path, "wb").write(self.view_entry(entry))
+
+class CPKCache:
+    """ On-disk cache of compressed files for CPKBuilder, keyed by their contents and the compression settings. """
+    __slots__ = ["dirname", "max_size", "max_age"]
+    dirname: str
+    max_size: int # In bytes.
+    max_age: float # In seconds since an entry was last used.
+    version = 2 # Bump when the compressor output changes, so old entries are not used.
+
+    def __init__(self, dirname: str, max_size: int = 4 << 30, max_age: float = 30 * 24 * 3600) -> None:
+        self.dirname = dirname
+        self.max_size = max_size
+        self.max_age = max_age
+        os.makedirs(dirname, exist_ok=True)
+
+    def key(self, data: bytes, *settings) -> str:
+        """ Key of a file, given everything that changes how it is compressed. """
+        h = hashlib.blake2b(repr((self.version,) + settings).encode(), digest_size=20)
+        h.update(data)
+        return h.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.dirname, key[:2], key)
+
+    def get(self, key: str) -> bytes:
+        """ Returns a cached file, or None. """
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Entries are evicted by last use.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written aside and renamed, so other threads or builds never read a partial entry.
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp, "wb") as f:
+            f.write(data)
+        os.replace(temp, path)
+
+    def evict(self) -> None:
+        """ Removes entries older than max_age, then the least recently used ones until the cache fits max_size. """
+        now = time.time()
+        entries = []
+        for root, _, files in os.walk(self.dirname):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                    if now - stat.st_mtime > self.max_age:
+                        os.remove(path)
                     else:
-                        extractsz = toctableL['ExtractSize'][idxg]
-                        flsize = toctableL['FileSize'][idxg]
-                        if extractsz > flsize:
-                            self.stream.seek(realOffset)
-                            comp_data = self.stream.read(toctableL['FileSize'][idxg])
-                            open(os.path.join(dirname, str(filename)), "wb").write(CriCodecs.CriLaylaDecompress(comp_data))
-                        else:
-                            open(os.path.join(dirname, str(filename)), "wb").write(self.stream.read(toctableL['FileSize'][idxg]))
-                    break
+                        entries.append((stat.st_mtime, stat.st_size, path))
+                except FileNotFoundError:
+                    pass # Removed by another build.
+        size = sum(entry[1] for entry in entries)
+        for _, filesize, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= filesize
 
 class CPKBuilder:
     """ Use this class to build semi-custom CPK archives. """
     __slots__ = ["CpkMode", "Tver", "dirname", "itoc_size", "encrypt", "encoding", "files", "fileslen",
                 "ITOCdata", "CPKdata", "ContentSize", "EnabledDataSize", "outfile", "TOCdata", "GTOCdata",
-                "ETOCdata", "compress", "EnabledPackedSize", "init_toc_len"]
+                "ETOCdata", "compress", "EnabledPackedSize", "init_toc_len", "sizes", "workers", "cache", "min_saving", "dedup"]
     CpkMode: int 
     # CPK mode dictates (at least from what I saw) the use of filenames in TOC or the use of
     # ITOC without any filenames (Use of ID's only, will be sorted).
@@ -233,12 +522,18 @@ class CPKBuilder:
     EnabledDataSize: int
     EnabledPackedSize: int
     outfile: str
-    compress: bool
-    init_toc_len: int # This is a bit of a redundancy, but some CPK's need it.
+    compress: int # CriLaylaCompress level, or False.
+    init_toc_len: int # Room kept for the TOC, files are written before it is built.
+    sizes: list # (extract size, stored size, FileOffset) of every file, in TOC order.
+    workers: int
+    cache: "CPKCache"
+    min_saving: float
+    dedup: bool
 
-    def __init__(self, dirname: str, outfile: str, CpkMode: int = 1, Tver: str = False, encrypt: bool = False, encoding: str = "utf-8", compress: bool = False) -> None:
+    def __init__(self, dirname: str, outfile: str, CpkMode: int = 1, Tver: str = False, encrypt: bool = False, encoding: str = "utf-8", compress = False, workers: int = None, cache = None, min_saving: float = 0.0, dedup: bool = False) -> None:
         self.CpkMode = CpkMode
-        self.compress = False
+        # compress can be True for the default level, or a CriLaylaCompress level from 1 (fastest) to 4 (smallest).
+        self.compress = compress_level(compress)
         if not Tver:
             # Some default ones I found with the matching CpkMode, hope they are good enough for all cases.
             if self.CpkMode == 0:
@@ -261,6 +556,9 @@ class CPKBuilder:
             # CpkMode of 0 is a bit hard to do with compression, as I don't know where the actual data would be
             # categorized (either H or L) after compression. Needs proper testing for me to implement.
             raise NotImplementedError("CpkMode of 0 with compression is not supported yet.")
+        elif self.CpkMode == 0 and dedup:
+            # Files of CpkMode 0 are found by adding up the sizes of the files before them.
+            raise ValueError("CpkMode of 0 can not share data between files.")
         self.dirname = dirname
         self.encrypt = encrypt
         self.encoding = encoding
@@ -268,7 +566,14 @@ class CPKBuilder:
         self.EnabledPackedSize = 0
         self.ContentSize = 0
         self.outfile = outfile
-        self.compress = compress
+        # Files are compressed on a thread pool of this many workers, None uses one per CPU.
+        self.workers = workers
+        # Compressed files are kept in cache between builds, given a CPKCache or a directory for one.
+        self.cache = CPKCache(cache) if type(cache) == str else cache
+        # Files are stored as they are unless compressing them saves at least this fraction of their size.
+        self.min_saving = min_saving
+        # With dedup, files with the same contents are stored once and share their TOC offset.
+        self.dedup = dedup
         self.generate_payload()
     
     def generate_payload(self):
@@ -276,64 +581,152 @@ class CPKBuilder:
             encflag = 0
         else:
             encflag = 0xFF
-        if self.CpkMode == 3:
-            self.TOCdata = self.generate_TOC()
-            self.TOCdata = bytearray(CPKChunkHeader.pack(b'TOC ', encflag, len(self.TOCdata), 0)) + self.TOCdata
-            self.TOCdata = self.TOCdata.ljust(len(self.TOCdata) + (0x800 - len(self.TOCdata) % 0x800), b'\x00')
-            assert self.init_toc_len == len(self.TOCdata)
-            self.GTOCdata = self.generate_GTOC()
-            self.GTOCdata = bytearray(CPKChunkHeader.pack(b'GTOC', encflag, len(self.GTOCdata), 0)) + self.GTOCdata
-            self.GTOCdata = self.GTOCdata.ljust(len(self.GTOCdata) + (0x800 - len(self.GTOCdata) % 0x800), b'\x00')
-            self.CPKdata = self.generate_CPK()
-            self.CPKdata = bytearray(CPKChunkHeader.pack(b'CPK ', encflag, len(self.CPKdata), 0)) + self.CPKdata
-            data = self.CPKdata.ljust(len(self.CPKdata) + (0x800 - len(self.CPKdata) % 0x800) - 6, b'\x00') + bytearray(b"(c)CRI") + self.TOCdata + self.GTOCdata
-            self.writetofile(data)
-        elif self.CpkMode == 2:
-            self.TOCdata = self.generate_TOC()
-            self.TOCdata = bytearray(CPKChunkHeader.pack(b'TOC ', encflag, len(self.TOCdata), 0)) + self.TOCdata
-            self.TOCdata = self.TOCdata.ljust(len(self.TOCdata) + (0x800 - len(self.TOCdata) % 0x800), b'\x00')
-            assert self.init_toc_len == len(self.TOCdata)
-            self.ITOCdata = self.generate_ITOC()
-            self.ITOCdata = bytearray(CPKChunkHeader.pack(b'ITOC', encflag, len(self.ITOCdata), 0)) + self.ITOCdata
-            self.ITOCdata = self.ITOCdata.ljust(len(self.ITOCdata) + (0x800 - len(self.ITOCdata) % 0x800), b'\x00')
-            self.CPKdata = self.generate_CPK()
-            self.CPKdata = bytearray(CPKChunkHeader.pack(b'CPK ', encflag, len(self.CPKdata), 0)) + self.CPKdata
-            data = self.CPKdata.ljust(len(self.CPKdata) + (0x800 - len(self.CPKdata) % 0x800) - 6, b'\x00') + bytearray(b"(c)CRI") + self.TOCdata + self.ITOCdata
-            self.writetofile(data)
-        elif self.CpkMode == 1:
-            self.TOCdata = self.generate_TOC()
-            self.TOCdata = bytearray(CPKChunkHeader.pack(b'TOC ', encflag, len(self.TOCdata), 0)) + self.TOCdata
-            self.TOCdata = self.TOCdata.ljust(len(self.TOCdata) + (0x800 - len(self.TOCdata) % 0x800), b'\x00')
-            assert self.init_toc_len == len(self.TOCdata)
-            self.CPKdata = self.generate_CPK()
-            self.CPKdata = bytearray(CPKChunkHeader.pack(b'CPK ', encflag, len(self.CPKdata), 0)) + self.CPKdata
-            data = self.CPKdata.ljust(len(self.CPKdata) + (0x800 - len(self.CPKdata) % 0x800) - 6, b'\x00') + bytearray(b"(c)CRI") + self.TOCdata
-            self.writetofile(data)
-        elif self.CpkMode == 0:
-            self.ITOCdata = self.generate_ITOC()
-            self.ITOCdata = bytearray(CPKChunkHeader.pack(b'ITOC', encflag, len(self.ITOCdata), 0)) + self.ITOCdata
-            self.ITOCdata = self.ITOCdata.ljust(len(self.ITOCdata) + (0x800 - len(self.ITOCdata) % 0x800), b'\x00')
-            self.CPKdata = self.generate_CPK()
-            self.CPKdata = bytearray(CPKChunkHeader.pack(b'CPK ', encflag, len(self.CPKdata), 0)) + self.CPKdata
-            data = self.CPKdata.ljust(len(self.CPKdata) + (0x800 - len(self.CPKdata) % 0x800) - 6, b'\x00') + bytearray(b"(c)CRI") + self.ITOCdata
-            self.writetofile(data)
-        
+        if self.CpkMode == 0:
+            self.ITOCdata = make_chunk(b'ITOC', self.generate_ITOC(), encflag)
+            self.CPKdata = make_chunk(b'CPK ', self.generate_CPK(), encflag)
+            self.writetofile(self.CPKdata[:0x800-6] + bytearray(b"(c)CRI") + self.ITOCdata)
+            return
+        # The TOC holds the final (compressed) file sizes, so files are written first, after the room kept for
+        # the header and the tables. The room for the TOC is its size with every size and offset column varying,
+        # which is the largest it can be.
+        self.files = []
+        self.get_files(sorted(os.listdir(self.dirname), key=lambda x: "".join([s if s != '_' else "~" for s in x]).lower()), self.dirname)
+        self.fileslen = len(self.files)
+        self.sizes = None
+        self.init_toc_len = chunk_size(self.generate_TOC())
+        tables = bytearray()
+        if self.CpkMode == 2:
+            self.ITOCdata = make_chunk(b'ITOC', self.generate_ITOC(), encflag)
+            tables = self.ITOCdata
+        elif self.CpkMode == 3:
+            self.GTOCdata = make_chunk(b'GTOC', self.generate_GTOC(), encflag)
+            tables = self.GTOCdata
+        with open(self.outfile, "wb", buffering=0) as out:
+            out.seek(0x800 + self.init_toc_len + len(tables))
+            self.write_files(out)
+            # The TOC is streamed into its room, anything it does not fill is left as zeros.
+            toc = self.generate_TOC()
+            assert chunk_size(toc) <= self.init_toc_len
+            out.seek(0x800)
+            out.write(CPKChunkHeader.pack(b'TOC ', encflag, toc.data_offset + 0x8, 0))
+            toc.write_to(out)
+            write_padding(out, 0x800 + self.init_toc_len - out.tell())
+            out.write(tables)
+            self.CPKdata = make_chunk(b'CPK ', self.generate_CPK(), encflag)
+            out.seek(0)
+            out.write(self.CPKdata[:0x800-6] + bytearray(b"(c)CRI"))
+
+    def write_files(self, out) -> None:
+        """ Writes every file in TOC order, compressing them on a thread pool when compression is enabled. """
+        self.sizes = []
+        first = self.find_duplicates() if self.dedup else [None] * len(self.files)
+        def load(file: str) -> tuple:
+            data = open(file, "rb").read()
+            sz = len(data)
+            if sz > 0xFFFFFFFF:
+                raise OverflowError("4GBs is the max size of a single file that can be bundled in a CPK archive of mode 1.")
+            # Files of 0x100 bytes or less can not be compressed, and readers take a file that is not
+            # smaller than its extract size as stored, so those are kept as they are.
+            if sz > 0x100:
+                compressed = None
+                if self.cache is not None:
+                    key = self.cache.key(data, self.compress, self.min_saving)
+                    compressed = self.cache.get(key)
+                if compressed is None:
+                    compressed = b""
+                    if self.worth_compressing(data):
+                        compressed = CriCodecs.CriLaylaCompress(data, self.compress)
+                    if self.cache is not None:
+                        # Files that are stored as they are, are cached as empty so they are not compressed again either.
+                        self.cache.put(key, compressed if self.saves(sz, len(compressed)) else b"")
+                if compressed and self.saves(sz, len(compressed)):
+                    data = compressed
+            return sz, data
+        def write(sz: int, fz: int, data: bytes = None) -> None:
+            # Without data, the file was already copied.
+            self.sizes.append((sz, fz, out.tell() - 0x800 - (fz if data is None else 0)))
+            self.EnabledPackedSize += sz
+            self.EnabledDataSize += fz
+            if data is not None:
+                out.write(data)
+            if fz % 0x800 != 0:
+                write_padding(out, 0x800 - fz % 0x800)
+                fz += 0x800 - fz % 0x800
+            self.ContentSize += fz
+        def share(index: int) -> None:
+            sz, fz, offset = self.sizes[index]
+            self.sizes.append((sz, fz, offset))
+            self.EnabledPackedSize += sz
+            self.EnabledDataSize += fz
+        if not self.compress:
+            for i, file in enumerate(self.files):
+                if first[i] is not None:
+                    share(first[i])
+                    continue
+                sz = copy_file(file, out)
+                if sz > 0xFFFFFFFF:
+                    raise OverflowError("4GBs is the max size of a single file that can be bundled in a CPK archive of mode 1.")
+                write(sz, sz)
+            return
+        workers = self.workers or os.cpu_count() or 1
+        with ThreadPoolExecutor(workers) as pool:
+            pending = deque()
+            def finish(index: int, future) -> None:
+                if future is None:
+                    share(first[index])
+                    return
+                sz, data = future.result()
+                write(sz, len(data), data)
+            # Results are written in TOC order, and only a few files per worker are kept in memory.
+            # Duplicates are not compressed, they come after the file they share data with.
+            for i, file in enumerate(self.files):
+                pending.append((i, None if first[i] is not None else pool.submit(load, file)))
+                if len(pending) >= workers * 2:
+                    finish(*pending.popleft())
+            for item in pending:
+                finish(*item)
+        if self.cache is not None:
+            self.cache.evict()
+
+    def find_duplicates(self) -> list:
+        """ Returns the index of the first file with the same contents for every file, or None.
+        Only files that have the same size as another file are hashed. """
+        sizes = dict()
+        for i, file in enumerate(self.files):
+            sizes.setdefault(os.path.getsize(file), []).append(i)
+        first = [None] * len(self.files)
+        for group in sizes.values():
+            if len(group) < 2:
+                continue
+            digests = dict()
+            for i in group:
+                h = hashlib.blake2b()
+                with open(self.files[i], "rb") as f:
+                    for chunk in iter(lambda: f.read(0x100000), b""):
+                        h.update(chunk)
+                j = digests.setdefault(h.digest(), i)
+                if j != i:
+                    first[i] = j
+        return first
+
+    def saves(self, size: int, compressed_size: int) -> bool:
+        return compressed_size < size and compressed_size <= size * (1 - self.min_saving)
+
+    def worth_compressing(self, data: bytes) -> bool:
+        """ Compresses a few pieces of large files first, already compressed media is then stored without compressing it whole. """
+        if len(data) < 0x40000:
+            return True
+        view = memoryview(data)
+        sample = b"".join([view[i:i+0x4000] for i in (0, len(data) // 2, len(data) - 0x4000)])
+        return self.saves(len(sample), len(CriCodecs.CriLaylaCompress(sample, self.compress)))
+
     def writetofile(self, data) -> None:
-        out = open(self.outfile, "wb")
-        out.write(data)
-        if self.compress:
-            for d in self.files:
-                if len(d) % 0x800 != 0:
-                    d = d.ljust(len(d) + (0x800 - len(d) % 0x800), b"\x00")
-                out.write(d)
-            out.close()
-        else:
+        with open(self.outfile, "wb", buffering=0) as out:
+            out.write(data)
             for i in self.files:
-                d = open(i, "rb").read()
-                if len(d) % 0x800 != 0:
-                    d = d.ljust(len(d) + (0x800 - len(d) % 0x800), b"\x00")
-                out.write(d)
-            out.close()
+                size = copy_file(i, out)
+                if size % 0x800 != 0:
+                    write_padding(out, 0x800 - size % 0x800)
     
     def generate_GTOC(self) -> bytearray:
         # I have no idea why are those numbers here.
@@ -399,73 +792,15 @@ class CPKBuilder:
         ]
         return UTFBuilder(payload, encrypt=self.encrypt, encoding=self.encoding, table_name="CpkEtocInfo").parse()
 
-    def generate_TOC(self) -> bytearray:
+    def generate_TOC(self) -> UTFBuilder:
+        # Without sizes, every size and offset is a distinct placeholder, to get the largest TOC.
+        # FileOffset is relative to the TOC.
         payload = []
-        self.files = []
-        temp = []
-        self.get_files(sorted(os.listdir(self.dirname), key=lambda x: "".join([s if s != '_' else "~" for s in x]).lower()), self.dirname)
-        count = 0
-        lent = 0
-        switch = False
-        sf = set()
-        sd = set()
-        for i in self.files:
-            # Dirname management.
-            dirname = os.path.dirname(i.split(self.dirname)[1])
-            if dirname.startswith(os.sep) or dirname.startswith("\\"):
-                dirname = dirname[1:]
-            if "\\" in dirname or os.sep in dirname:
-                dirname = dirname.replace("\\", "/")
-                dirname = dirname.replace(os.sep, "/")
-            if dirname not in sd:
-                switch = True
-                lent += len(dirname) + 1
-                sd.update({dirname})
-            
-            # Filename management.
-            flname = os.path.basename(i)
-            if flname not in sf:
-                lent += len(flname) + 1
-                sf.update({flname})
-            count += 1
-        
-        # This estimates how large the TOC table size is.
-        if switch and len(sd) != 1:
-            lent = (lent + (4 + 4 + 4 + 4 + 8 + 4) * count + 0x47 + 0x51) # 0x47 is header len when there are mutiple dirs.
-        else:
-            lent = (lent + (4 + 4 + 4 + 8 + 4) * count + 0x4B + 0x51) # 0x4B is header len when there is only one dir.
-        if lent % 8 != 0:
-            lent = 8 + (lent - 8) + (8 - (lent - 8) % 8)
-        lent += 0x10
-        lent = lent + (0x800 - lent % 0x800)
-        # init_toc_len will also be the first file offset.
-        # Used to assert that the estimated TOC length is equal to the actual length, just in case the estimating went wrong. 
-        self.init_toc_len = lent
-
-        self.fileslen = count
-        count = 0
-        for file in self.files:
-            sz = os.stat(file).st_size
-            fz = sz
-            if sz > 0xFFFFFFFF:
-                raise OverflowError("4GBs is the max size of a single file that can be bundled in a CPK archive of mode 1.")
-            if self.compress:
-                self.EnabledPackedSize += sz
-                comp_data = CriCodecs.CriLaylaCompress(open(file, "rb").read())
-                temp.append(comp_data)
-                fz = len(comp_data)
-                self.EnabledDataSize += fz
-                if fz % 0x800 != 0:
-                    self.ContentSize += fz + (0x800 - fz % 0x800)
-                else:
-                    self.ContentSize += fz
+        for count, file in enumerate(self.files):
+            if self.sizes is not None:
+                sz, fz, offset = self.sizes[count]
             else:
-                self.EnabledDataSize += sz
-                self.EnabledPackedSize += sz
-                if sz % 0x800 != 0:
-                    self.ContentSize += sz + (0x800 - sz % 0x800)
-                else:
-                    self.ContentSize += sz
+                sz = fz = offset = count
             dirname = os.path.dirname(file.split(self.dirname)[1])
             if dirname.startswith(os.sep) or dirname.startswith("\\"):
                 dirname = dirname[1:]
@@ -476,22 +811,14 @@ class CPKBuilder:
                 {
                     "DirName": (UTFTypeValues.string, dirname),
                     "FileName": (UTFTypeValues.string, os.path.basename(file)),
-                    "FileSize": (UTFTypeValues.uint, sz),
-                    "ExtractSize": (UTFTypeValues.uint, (sz if not self.compress else fz)),
-                    "FileOffset": (UTFTypeValues.ullong, lent),
+                    "FileSize": (UTFTypeValues.uint, fz),
+                    "ExtractSize": (UTFTypeValues.uint, sz),
+                    "FileOffset": (UTFTypeValues.ullong, offset),
                     "ID": (UTFTypeValues.uint, count),
                     "UserString": (UTFTypeValues.string, "<NULL>")
                 }
             )
-            count += 1
-            sz = fz
-            if sz % 0x800 != 0:
-                lent += sz + (0x800 - sz % 0x800)
-            else:
-                lent += sz
-        if self.compress:
-            self.files = temp
-        return UTFBuilder(payload, encrypt=self.encrypt, encoding=self.encoding, table_name="CpkTocInfo").parse()
+        return UTFBuilder(payload, encrypt=self.encrypt, encoding=self.encoding, table_name="CpkTocInfo")
 
     def get_files(self, lyst, root):
         for i in lyst:
@@ -503,17 +830,17 @@ class CPKBuilder:
 
     def generate_CPK(self) -> bytearray:
         if self.CpkMode == 3:
-            ContentOffset = (0x800+len(self.TOCdata)+len(self.GTOCdata))
+            ContentOffset = (0x800+self.init_toc_len+len(self.GTOCdata))
             CpkHeader = [
                 {
                     "UpdateDateTime": (UTFTypeValues.ullong, 0),
                     "ContentOffset": (UTFTypeValues.ullong, ContentOffset),
                     "ContentSize": (UTFTypeValues.ullong, self.ContentSize),
                     "TocOffset": (UTFTypeValues.ullong, 0x800),
-                    "TocSize": (UTFTypeValues.ullong, len(self.TOCdata)),
+                    "TocSize": (UTFTypeValues.ullong, self.init_toc_len),
                     "EtocOffset": (UTFTypeValues.ullong, None),
                     "EtocSize": (UTFTypeValues.ullong, None),
-                    "GtocOffset": (UTFTypeValues.ullong, 0x800+len(self.TOCdata)),
+                    "GtocOffset": (UTFTypeValues.ullong, 0x800+self.init_toc_len),
                     "GtocSize": (UTFTypeValues.ullong, len(self.GTOCdata)),                    
                     "EnabledPackedSize": (UTFTypeValues.ullong, self.EnabledPackedSize),
                     "EnabledDataSize": (UTFTypeValues.ullong, self.EnabledDataSize),
@@ -553,17 +880,17 @@ class CPKBuilder:
                 }
             ]
         elif self.CpkMode == 2:
-            ContentOffset = 0x800+len(self.TOCdata)+len(self.ITOCdata)
+            ContentOffset = 0x800+self.init_toc_len+len(self.ITOCdata)
             CpkHeader = [
                 {
                     "UpdateDateTime": (UTFTypeValues.ullong, 0),
                     "ContentOffset": (UTFTypeValues.ullong, ContentOffset),
                     "ContentSize": (UTFTypeValues.ullong, self.ContentSize),
                     "TocOffset": (UTFTypeValues.ullong, 0x800),
-                    "TocSize": (UTFTypeValues.ullong, len(self.TOCdata)),
+                    "TocSize": (UTFTypeValues.ullong, self.init_toc_len),
                     "EtocOffset": (UTFTypeValues.ullong, None),
                     "EtocSize": (UTFTypeValues.ullong, None),
-                    "ItocOffset": (UTFTypeValues.ullong, 0x800+len(self.TOCdata)),
+                    "ItocOffset": (UTFTypeValues.ullong, 0x800+self.init_toc_len),
                     "ItocSize": (UTFTypeValues.ullong, len(self.ITOCdata)),
                     "EnabledPackedSize": (UTFTypeValues.ullong, self.EnabledPackedSize),
                     "EnabledDataSize": (UTFTypeValues.ullong, self.EnabledDataSize),
@@ -602,7 +929,7 @@ class CPKBuilder:
                 }
             ]
         elif self.CpkMode == 1:
-            ContentOffset = 0x800 + len(self.TOCdata)
+            ContentOffset = 0x800 + self.init_toc_len
             CpkHeader = [
                 {
                     "UpdateDateTime": (UTFTypeValues.ullong, 0),
@@ -610,7 +937,7 @@ class CPKBuilder:
                     "ContentOffset": (UTFTypeValues.ullong, ContentOffset),
                     "ContentSize": (UTFTypeValues.ullong, self.ContentSize),
                     "TocOffset": (UTFTypeValues.ullong, 0x800),
-                    "TocSize": (UTFTypeValues.ullong, len(self.TOCdata)),
+                    "TocSize": (UTFTypeValues.ullong, self.init_toc_len),
                     "TocCrc": (UTFTypeValues.uint, None),
                     "EtocOffset": (UTFTypeValues.ullong, None),
                     "EtocSize": (UTFTypeValues.ullong, None),
@@ -753,4 +1080,284 @@ class CPKBuilder:
                    "DataH" : (UTFTypeValues.bytes, UTFBuilder(datah, table_name="CpkItocH", encrypt=False, encoding=self.encoding).parse())
                 }
             ]
-            return UTFBuilder(payload, table_name="CpkItocInfo", encrypt=self.encrypt, encoding=self.encoding).parse()
\ No newline at end of file
+            return UTFBuilder(payload, table_name="CpkItocInfo", encrypt=self.encrypt, encoding=self.encoding).parse()
+
+class CPKPatcher:
+    """ Use this class to replace, add or remove files of an existing CPK without rebuilding it. """
+    __slots__ = ["filename", "compress", "cpk", "toc", "itoc", "encflag", "encrypted", "rows", "data",
+                "keys", "paths", "names", "ids", "next_id"]
+    filename: str
+    compress: int
+    cpk: CPK
+    toc: UTF
+    itoc: UTF # CpkExtendId table of CpkMode 2, or None.
+    encflag: int
+    encrypted: bool
+    rows: list # TOC rows, in TOC order.
+    data: list # New stored data of every row, None for data that is already in the archive.
+    keys: list # toc_key of every row, sorted along with the rows.
+    paths: dict # (DirName, FileName) to row.
+    names: dict # FileName to the first row with it.
+    ids: dict # ID (or TOC index without an ID column) to row.
+    next_id: int
+
+    def __init__(self, filename: str, compress = False) -> None:
+        # New data goes into free aligned gaps of the archive or at its end, and only the TOC, the ITOC and the
+        # CpkHeader are rewritten. compress is a CriLaylaCompress level (or True) for the new files.
+        self.filename = filename
+        self.compress = compress_level(compress)
+        self.load()
+
+    def load(self) -> None:
+        self.cpk = CPK(self.filename)
+        tables = self.cpk.tables
+        if "TOC" not in tables:
+            raise NotImplementedError("Patching CpkMode 0 archives is not supported yet.")
+        elif "HTOC" in tables or "HGTOC" in tables:
+            raise NotImplementedError("Patching archives with hash tables is not supported yet.")
+        elif "ITOC" in tables and "TocIndex" not in tables["ITOC"]:
+            raise NotImplementedError("Patching archives with an ITOC of sizes is not supported yet.")
+        self.encflag, data = self.read_chunk(tables["CPK"]["TocOffset"][0])
+        self.encrypted = bytes(data[:4]) == UTFType.EUTF.value
+        pools = dict()
+        self.toc = UTF(data, pools=pools)
+        self.rows = self.toc.get_payload()[:len(self.cpk.files)]
+        self.data = [None] * len(self.rows)
+        self.keys = [toc_key(row) for row in self.rows]
+        self.paths = dict()
+        self.names = dict()
+        self.ids = dict()
+        for i, row in enumerate(self.rows):
+            self.paths.setdefault((row["DirName"][1], row["FileName"][1]), row)
+            self.names.setdefault(row["FileName"][1], row)
+            self.ids.setdefault(row["ID"][1] if "ID" in row else i, row)
+        self.next_id = max([row["ID"][1] for row in self.rows if "ID" in row], default=-1) + 1
+        self.itoc = UTF(self.read_chunk(tables["CPK"]["ItocOffset"][0])[1], pools=pools) if "ITOC" in tables else None
+
+    def read_chunk(self, offset: int) -> tuple:
+        """ Returns the encryption flag and the @UTF table of a chunk. """
+        self.cpk.stream.seek(offset, 0)
+        _, encflag, size, _ = CPKChunkHeader.unpack(self.cpk.stream.read(CPKChunkHeader.size))
+        return encflag, self.cpk.stream.read(size)
+
+    def find(self, filename) -> int:
+        """ Returns the TOC row of a "DirName/FileName" path, a FileName, or an ID. """
+        if type(filename) == int:
+            row = self.ids.get(filename)
+        elif filename in self.names:
+            row = self.names[filename]
+        else:
+            row = self.paths.get(tuple(filename.rsplit("/", 1))) if "/" in filename else None
+        if row is None:
+            raise ValueError("Given filename does not exist inside the provided CPK.")
+        return self.position(row)
+
+    def position(self, row: dict) -> int:
+        """ Returns the index of a row, found by its sort key unless the archive was not sorted the same way. """
+        key = toc_key(row)
+        for i in range(bisect_left(self.keys, key), len(self.rows)):
+            if self.rows[i] is row:
+                return i
+            if self.keys[i] != key:
+                break
+        return next(i for i, r in enumerate(self.rows) if r is row)
+
+    def store(self, data: bytes) -> tuple:
+        """ Returns the extract size and the stored data of a file, compressing it if it gets smaller. """
+        sz = len(data)
+        if sz > 0xFFFFFFFF:
+            raise OverflowError("4GBs is the max size of a single file that can be bundled in a CPK archive of mode 1.")
+        if self.compress and sz > 0x100:
+            compressed = CriCodecs.CriLaylaCompress(data, self.compress)
+            if len(compressed) < sz:
+                return sz, compressed
+        return sz, bytes(data)
+
+    def set_data(self, index: int, data: bytes) -> None:
+        row = self.rows[index]
+        sz, self.data[index] = self.store(data)
+        row["FileSize"] = (row["FileSize"][0], len(self.data[index]))
+        row["ExtractSize"] = (row["ExtractSize"][0], sz)
+        if "CRC" in row:
+            # CRC32 of the extracted file, checked by the engine and by incremental extraction.
+            row["CRC"] = (row["CRC"][0], zlib.crc32(data))
+
+    def replace(self, filename, data: bytes) -> None:
+        """ Replaces the contents of a file, given its path, name or ID. """
+        self.set_data(self.find(filename), data)
+
+    def add(self, filename: str, data: bytes, id: int = None) -> None:
+        """ Adds a file at a "DirName/FileName" path, IDs default to one past the largest one. """
+        dirname, name = filename.rsplit("/", 1) if "/" in filename else ("", filename)
+        if (dirname, name) in self.paths:
+            raise ValueError("Given filename already exists inside the provided CPK.")
+        if self.rows:
+            row = dict(self.rows[0])
+        else:
+            row = {
+                "DirName": (UTFTypeValues.string, ""),
+                "FileName": (UTFTypeValues.string, ""),
+                "FileSize": (UTFTypeValues.uint, 0),
+                "ExtractSize": (UTFTypeValues.uint, 0),
+                "FileOffset": (UTFTypeValues.ullong, 0),
+                "ID": (UTFTypeValues.uint, 0),
+                "UserString": (UTFTypeValues.string, "<NULL>")
+            }
+        if id is None:
+            id = self.next_id
+        row["DirName"] = (row["DirName"][0], dirname)
+        row["FileName"] = (row["FileName"][0], name)
+        if "ID" in row:
+            row["ID"] = (row["ID"][0], id)
+            self.ids.setdefault(id, row)
+            self.next_id = max(self.next_id, id + 1)
+        self.paths[(dirname, name)] = row
+        self.names.setdefault(name, row)
+        # The TOC is kept sorted by path.
+        key = toc_key(row)
+        index = bisect_right(self.keys, key)
+        self.rows.insert(index, row)
+        self.keys.insert(index, key)
+        self.data.insert(index, None)
+        self.set_data(index, data)
+
+    def remove(self, filename) -> None:
+        """ Removes a file, given its path, name or ID. """
+        index = self.find(filename)
+        row = self.rows[index]
+        # Rows without an ID column are in ids under their index when the archive was loaded.
+        id = row["ID"][1] if "ID" in row else next((k for k, r in self.ids.items() if r is row), None)
+        for table, key in [(self.paths, (row["DirName"][1], row["FileName"][1])), (self.names, row["FileName"][1]), (self.ids, id)]:
+            if table.get(key) is row:
+                del table[key]
+        del self.rows[index]
+        del self.keys[index]
+        del self.data[index]
+
+    def save(self) -> None:
+        """ Writes the new files and tables into the archive. """
+        if not self.rows:
+            raise ValueError("A CPK archive needs at least one file.")
+        header = self.cpk.tables["CPK"]
+        align = header["Align"][0] if "Align" in header else 0x800
+        aligned = lambda x: x + (-x % align)
+        tocoff = header["TocOffset"][0]
+        # The room for the TOC is its size with every offset varying, which is the largest it can be.
+        offsets = [row["FileOffset"] for row in self.rows]
+        for i, row in enumerate(self.rows):
+            row["FileOffset"] = (offsets[i][0], i)
+        toc_size = chunk_size(self.toc_builder())
+        itoc = self.generate_ITOC() if self.itoc is not None else bytearray()
+        tables_end = tocoff + toc_size + len(itoc)
+
+        # Data that stays in the archive, several files can share the same data. Tables other than the TOC
+        # and the ITOC are kept as they are.
+        blocks = dict()
+        for i, row in enumerate(self.rows):
+            if self.data[i] is None:
+                start = tocoff + offsets[i][1]
+                blocks[start] = max(blocks.get(start, start), start + aligned(row["FileSize"][1]))
+        kept = dict()
+        for name in ["Gtoc", "Etoc"]:
+            if name+"Offset" in header and header[name+"Offset"][0]:
+                start = header[name+"Offset"][0]
+                blocks[start] = start + aligned(header[name+"Size"][0])
+                kept[name] = start
+        end = aligned(max([tables_end] + list(blocks.values())))
+        # Anything in the way of the tables is moved after them.
+        moves = {start: stop for start, stop in blocks.items() if start < tables_end}
+        for start in moves:
+            del blocks[start]
+        gaps = []
+        pos = aligned(max([tables_end] + list(moves.values())))
+        for start in sorted(blocks):
+            if start > pos:
+                gaps.append([pos, start])
+            pos = max(pos, blocks[start])
+        def allocate(size: int) -> int:
+            nonlocal end
+            size = aligned(size)
+            for gap in gaps:
+                if gap[1] - gap[0] >= size:
+                    gap[0] += size
+                    return gap[0] - size
+            end += size
+            return end - size
+
+        with open(self.filename, "r+b", buffering=0) as out:
+            moved = dict()
+            for start in sorted(moves):
+                moved[start] = allocate(moves[start] - start)
+                self.cpk.stream.seek(start, 0)
+                out.seek(moved[start])
+                for i in range(start, moves[start], 0x100000):
+                    out.write(self.cpk.stream.read(min(0x100000, moves[start] - i)))
+            ContentOffset = None
+            ContentSize = 0
+            written = set()
+            for i, row in enumerate(self.rows):
+                if self.data[i] is None:
+                    start = moved.get(tocoff + offsets[i][1], tocoff + offsets[i][1])
+                else:
+                    start = allocate(len(self.data[i]))
+                    out.seek(start)
+                    out.write(self.data[i])
+                    write_padding(out, -len(self.data[i]) % align)
+                row["FileOffset"] = (offsets[i][0], start - tocoff)
+                ContentOffset = start if ContentOffset is None else min(ContentOffset, start)
+                if start not in written:
+                    written.add(start)
+                    ContentSize += aligned(row["FileSize"][1])
+
+            toc = make_chunk(b'TOC ', self.toc_builder().parse(), self.encflag)
+            assert len(toc) <= toc_size
+            out.seek(tocoff)
+            out.write(toc)
+            write_padding(out, toc_size - len(toc))
+            out.write(itoc)
+
+            values = {
+                "ContentOffset": ContentOffset,
+                "ContentSize": ContentSize,
+                "TocSize": toc_size,
+                "EnabledPackedSize": sum(row["ExtractSize"][1] for row in self.rows),
+                "EnabledDataSize": sum(row["FileSize"][1] for row in self.rows),
+                "Files": len(self.rows)
+            }
+            if itoc:
+                values["ItocOffset"] = tocoff + toc_size
+                values["ItocSize"] = len(itoc)
+            for name, start in kept.items():
+                values[name+"Offset"] = moved.get(start, start)
+            self.cpk.stream.seek(0, 0)
+            _, encflag, size, unk0C = CPKChunkHeader.unpack(self.cpk.stream.read(CPKChunkHeader.size))
+            patcher = UTFPatcher(bytearray(self.cpk.stream.read(size)))
+            for name, value in values.items():
+                if name in header:
+                    patcher.set(name, 0, value)
+            data = CPKChunkHeader.pack(b'CPK ', encflag, len(patcher.data), unk0C) + patcher.data
+            if len(data) > 0x800 - 6:
+                raise ValueError("CpkHeader does not fit in the CPK header anymore.")
+            out.seek(0)
+            out.write(data)
+            write_padding(out, 0x800 - 6 - len(data))
+            out.truncate(end)
+        self.cpk.stream.close()
+        self.load()
+
+    def toc_builder(self) -> UTFBuilder:
+        return UTFBuilder(self.rows, encrypt=self.encrypted, encoding=self.toc.encoding, table_name=self.toc.table_name)
+
+    def generate_ITOC(self) -> bytearray:
+        # CpkExtendId maps every ID to its TOC row.
+        types = self.itoc.get_payload()[0]
+        payload = []
+        for i, row in enumerate(self.rows):
+            payload.append(
+                {
+                    "ID": (types["ID"][0], row["ID"][1] if "ID" in row else i),
+                    "TocIndex": (types["TocIndex"][0], i)
+                }
+            )
+        payload.sort(key=lambda x: x["ID"][1])
+        return make_chunk(b'ITOC', UTFBuilder(payload, encrypt=self.encrypted, encoding=self.itoc.encoding, table_name=self.itoc.table_name).parse(), self.encflag)
\ No newline at end of file
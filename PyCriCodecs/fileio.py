@@ -0,0 +1,46 @@
+import os
+
+ZEROS = bytes(0x800)
+
+def write_padding(out, size: int) -> None:
+    """ Writes size zero bytes, without allocating them. """
+    view = memoryview(ZEROS)
+    while size > 0:
+        size -= out.write(view[:min(size, len(ZEROS))])
+
+def copy_range(src, offset: int, size: int, out) -> int:
+    """ Copies size bytes of src from offset at the current position of out, in the kernel when the platform allows it.
+    Both must be unbuffered files, src is only moved when the copy falls back to reading it. Returns the copied size. """
+    copied = 0
+    # Both take the source offset explicitly and move the destination offset, like a write would.
+    for copy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+        if copy is None:
+            continue
+        try:
+            while copied < size:
+                if copy is os.sendfile:
+                    n = copy(out.fileno(), src.fileno(), offset + copied, size - copied)
+                else:
+                    n = copy(src.fileno(), out.fileno(), size - copied, offset + copied)
+                if n == 0:
+                    break
+                copied += n
+            break
+        except OSError:
+            # Not supported between those files (e.g. across filesystems on older kernels), try the next one.
+            if copied:
+                raise
+    if copied < size:
+        src.seek(offset + copied)
+        while copied < size:
+            data = src.read(min(0x100000, size - copied))
+            if not data:
+                break
+            out.write(data)
+            copied += len(data)
+    return copied
+
+def copy_file(path: str, out) -> int:
+    """ Copies a file at the current position of out, which must be unbuffered. Returns the size of the file. """
+    with open(path, "rb", buffering=0) as src:
+        return copy_range(src, 0, os.fstat(src.fileno()).st_size, out)
\ No newline at end of file
@@ -136,12 +136,13 @@ class USM:
         """ Gets data from USM chunks and assignes them to output. """
         self.stream.seek(0)
         self.__fileinfo = list() # Prototype, should be improved.
+        pools = dict() # Header chunks mostly repeat the same strings.
         header, chuncksize, unk08, offset, padding, chno, unk0D, unk0E, type, frametime, framerate, unk18, unk1C = USMChunkHeader.unpack(
             self.stream.read(USMChunkHeader.size)
         )
         chuncksize -= 0x18
         offset -= 0x18
-        self.CRIDObj = UTF(self.stream.read(chuncksize))
+        self.CRIDObj = UTF(self.stream.read(chuncksize), pools=pools)
         CRID_payload = self.CRIDObj.get_payload()
         self.__fileinfo.append({self.CRIDObj.table_name: CRID_payload})
         headers = [(int.to_bytes(x['stmid'][1], 4, "big")).decode() for x in CRID_payload[1:]]
@@ -161,7 +162,7 @@ class USM:
                     data = self.reader(chuncksize, offset, padding, header)
                     output[header.decode()+"_"+str(chno)].extend(data)
                 elif type == 1 or type == 3:
-                    ChunkObj = UTF(self.stream.read(chuncksize))
+                    ChunkObj = UTF(self.stream.read(chuncksize), pools=pools)
                     self.__fileinfo.append({ChunkObj.table_name: ChunkObj.get_payload()})
                     if type == 1 and header == USMChunckHeaderType.SFA.value:
                         codec = ChunkObj.get_payload()[0]
@@ -178,7 +179,7 @@ class USM:
                         data = self.reader(chuncksize, offset, padding, header)
                         output[header.decode()+"_0"].extend(data) # No channel number info, code here assumes it's a one channel data type.
                     elif type == 1 or type == 3:
-                        ChunkObj = UTF(self.stream.read(chuncksize))
+                        ChunkObj = UTF(self.stream.read(chuncksize), pools=pools)
                         self.__fileinfo.append({ChunkObj.table_name: ChunkObj.get_payload()})
                         if type == 1 and header == USMChunckHeaderType.SFA.value:
                             codec = ChunkObj.get_payload()[0]
@@ -1,14 +1,71 @@
 from typing import BinaryIO
 from io import BytesIO, FileIO
-from struct import unpack, calcsize, pack
+from struct import unpack_from, calcsize, pack, Struct
+from collections.abc import Mapping
+from array import array
+import mmap
 from .chunk import *
+try:
+    from CriCodecs import UtfParse, UtfCrypt
+except ImportError:
+    UtfParse = UtfCrypt = None
+
+# @UTF encryption XORs every byte with the low byte of an LCG (m = 0x655f, t = 0x4115),
+# which repeats every 64 bytes, so one period of it is all that has to be kept.
+UTFKeystream = bytes((0x655f * pow(0x4115, i, 1 << 32)) & 0xFF for i in range(64))
+
+def utf_crypt(data: bytearray, position: int = 0) -> None:
+    """ Encrypts or decrypts @UTF data in place, position is the offset of data inside the table. """
+    if UtfCrypt is not None:
+        UtfCrypt(data, position)
+        return
+    length = len(data)
+    start = position % len(UTFKeystream)
+    keystream = (UTFKeystream * (length // len(UTFKeystream) + 2))[start:start+length]
+    data[:] = (int.from_bytes(data, "little") ^ int.from_bytes(keystream, "little")).to_bytes(length, "little")
+
+def read_string_pool(pool: bytes) -> "StringPool":
+    """ Decodes a @UTF string pool. """
+    strings = StringPool(pool)
+    pieces = pool.split(b'\x00')
+    # The encoding is decided once for the whole pool, utf-8 and shift-jis never have a null byte inside a string.
+    for encoding in ["utf-8", "shift-jis"]:
+        try:
+            decoded = pool.decode(encoding).split('\x00')
+        except UnicodeDecodeError:
+            continue
+        if len(decoded) == len(pieces):
+            strings.encoding = encoding
+            offset = 0
+            for piece, string in zip(pieces, decoded):
+                strings[offset] = string
+                offset += len(piece) + 1
+            return strings
+    strings.encoding = 'utf-8'
+    offset = 0
+    for string in pieces:
+        try:
+            strings[offset] = string.decode("utf-8")
+        except:
+            for x in ["shift-jis", "utf-16"]:
+                try:
+                    strings[offset] = string.decode(x)
+                    strings.encoding = x
+                    # This looks sketchy, but it will always work since @UTF only supports these 3 encodings. 
+                    break
+                except:
+                    continue
+            else:
+                # Probably useless.
+                raise UnicodeDecodeError(f"String of unknown encoding: {string}")
+        offset += len(string) + 1
+    return strings
 
-# FIXME Really awful. Although works.
 class UTF:
     """ Use this class to return a dict containing all @UTF chunk information. """
     __slots__ = ["magic", "table_size", "rows_offset", "string_offset", "data_offset",
                 "table_name", "num_columns", "row_length", "num_rows", "stream", "table",
-                "__payload", "encoding"]
+                "__payload", "__schema", "__strings", "__values", "encoding", "data"]
     magic: bytes
     table_size: int
     rows_offset: int
@@ -21,139 +78,241 @@ class UTF:
     stream: BinaryIO
     table: dict
     __payload: list
+    __schema: list
+    __strings: dict
+    __values: dict
     encoding: str
-    def __init__(self, stream):
+    data: memoryview
+    def __init__(self, stream, lazy: bool = False, pools: dict = None):
+        # With lazy, the table is kept as a zero-copy view of the given buffer (or an mmap of the given file),
+        # and columns are only decoded when they are accessed.
+        # pools maps string pools to their decoded strings, tables read from the same file can share one
+        # so that a pool they have in common is only decoded once.
         if type(stream) == str:
-            self.stream = FileIO(stream)
+            if lazy:
+                with open(stream, "rb") as f:
+                    self.data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            else:
+                self.stream = FileIO(stream)
+                self.data = memoryview(self.stream.read())
         else:
-            self.stream = BytesIO(stream)
-        self.magic, self.table_size, self.rows_offset, self.string_offset, self.data_offset, self.table_name, self.num_columns, self.row_length, self.num_rows = UTFChunkHeader.unpack(
-            self.stream.read(UTFChunkHeader.size)
+            if not lazy:
+                self.stream = BytesIO(stream)
+            self.data = memoryview(stream).cast("B")
+        self.__payload = None
+        self.__values = dict()
+        columns = None
+        if UtfParse is not None and not lazy:
+            # The native parser decrypts and decodes every column in one call.
+            data, columns = UtfParse(self.data)
+            if data is not None:
+                self.stream = BytesIO(data)
+                self.data = memoryview(data)
+        self.magic, self.table_size, self.rows_offset, self.string_offset, self.data_offset, self.table_name, self.num_columns, self.row_length, self.num_rows = UTFChunkHeader.unpack_from(
+            self.data
         )
-        if self.magic == UTFType.UTF.value:
-            self.table = self.read_rows_and_columns()
-        elif self.magic == UTFType.EUTF.value:
-            self.stream.seek(0)
-            data = memoryview(bytearray(self.stream.read()))
-            m = 0x655f
-            t = 0x4115
-            for i in range(len(data)):
-                data[i] ^= (0xFF & m)
-                m = (m * t) & 0xFFFFFFFF
-            self.stream = BytesIO(bytearray(data))
-            self.magic, self.table_size, self.rows_offset, self.string_offset, self.data_offset, self.table_name, self.num_columns, self.row_length, self.num_rows = UTFChunkHeader.unpack(
-                self.stream.read(UTFChunkHeader.size)
+        if self.magic == UTFType.EUTF.value:
+            data = bytearray(self.data)
+            utf_crypt(data)
+            if not lazy:
+                self.stream = BytesIO(data)
+            self.data = memoryview(data)
+            self.magic, self.table_size, self.rows_offset, self.string_offset, self.data_offset, self.table_name, self.num_columns, self.row_length, self.num_rows = UTFChunkHeader.unpack_from(
+                self.data
             )
             if self.magic != UTFType.UTF.value:
                 raise Exception("Decryption error.")
-            self.table = self.read_rows_and_columns()
-        else:
+        elif self.magic != UTFType.UTF.value:
             raise ValueError("UTF chunk is not present.")
-    
-    def read_rows_and_columns(self) -> dict:
-        stream = self.stream.read(self.data_offset-0x18)
-        stream = BytesIO(stream)
-        types = [[], [], [], []]
-        target_data = []
-        target_constant = []
-        target_tuple = []
-        for i in range(self.num_columns):
-            flag = stream.read(1)[0]
+        self.read_schema(columns, pools)
+        if lazy:
+            self.table = UTFTableView(self)
+        else:
+            self.table = self.read_rows_and_columns()
+
+    def read_schema(self, columns: list = None, pools: dict = None) -> None:
+        """ Reads the column definitions and constant values, 0x50 columns are kept as offsets into a row. """
+        data = self.data
+        strings = self.__strings = self.read_strings(bytes(data[self.string_offset+0x8:self.data_offset+0x8]), pools)
+        binary = self.data_offset + 0x8
+        self.table_name = strings[self.table_name]
+        if columns is None:
+            columns = self.read_column_definitions()
+        self.__schema = []
+        offset = 0
+        for flag, name, value in columns:
             stflag = flag >> 4
             typeflag = flag & 0xF
+            name = strings[name]
             if stflag == 0x1:
-                target_constant.append(int.from_bytes(stream.read(4), "big"))
-                types[2].append((">"+self.stringtypes(typeflag), typeflag))
+                if typeflag == 0xA:
+                    self.__schema.append((0x10, typeflag, name, "<NULL>"))
+                elif typeflag == 0xB:
+                    # Most likely useless, since the code doesn seem to reach here.
+                    self.__schema.append((0x10, typeflag, name, b''))
+                else:
+                    self.__schema.append((0x10, typeflag, name, None))
             elif stflag == 0x3:
-                target_tuple.append((int.from_bytes(stream.read(4), "big"), unpack(">"+self.stringtypes(typeflag), stream.read(calcsize(self.stringtypes(typeflag))))))
-                types[1].append((">"+self.stringtypes(typeflag), typeflag))
+                if typeflag == 0xA:
+                    value = strings[value]
+                elif typeflag == 0xB:
+                    value = bytes(data[binary+value[0]:binary+value[0]+value[1]])
+                else:
+                    value = (value,)
+                self.__schema.append((0x30, typeflag, name, value))
             elif stflag == 0x5:
-                target_data.append(int.from_bytes(stream.read(4), "big"))
-                types[0].append((">"+self.stringtypes(typeflag), typeflag))
+                if value is not None:
+                    # Already decoded natively as a compact array.
+                    self.__values[len(self.__schema)] = self.read_array(typeflag, value)
+                self.__schema.append((0x50, typeflag, name, offset))
+                offset += calcsize(">"+self.stringtypes(typeflag))
+
+    def read_column_definitions(self) -> list:
+        """ Returns a list of (flag, name pointer, constant value) of every column. """
+        data = self.data
+        columns = []
+        pos = UTFChunkHeader.size
+        for i in range(self.num_columns):
+            flag = data[pos]
+            stflag = flag >> 4
+            typeflag = flag & 0xF
+            name = int.from_bytes(data[pos+1:pos+5], "big")
+            pos += 5
+            if stflag == 0x1 or stflag == 0x5:
+                columns.append((flag, name, None))
+            elif stflag == 0x3:
+                fmt = ">"+self.stringtypes(typeflag)
+                value = unpack_from(fmt, data, pos)
+                pos += calcsize(fmt)
+                columns.append((flag, name, value if typeflag == 0xB else value[0]))
             elif stflag == 0x7: # Exists in old CPK's.
-                # target_tuple.append((int.from_bytes(stream.read(4), "big"), int.from_bytes(stream.read(calcsize(self.stringtypes(typeflag))), "big")))
-                # types[3].append((">"+self.stringtypes(typeflag), typeflag))
                 raise NotImplementedError("Unsupported 0x70 storage flag.")
             else:
                 raise Exception("Unknown storage flag.")
-        
-        rows  = []
-        table = dict()
-        for j in range(self.num_rows):
-            for i in types[0]:
-                rows.append(unpack(i[0], stream.read(calcsize(i[0]))))
-
-        for i in range(4):
-            for j in range(len(types[i])):
-                types[i][j] = (types[i][j][0][1:], types[i][j][1])
-        strings = (stream.read()).split(b'\x00')
-        strings_copy = strings[:]
-        self.__payload = []
-        self.encoding = 'utf-8'
-        for i in range(len(strings)):
-                try:
-                    strings_copy[i] = strings[i].decode("utf-8")
-                except:
-                    for x in ["shift-jis", "utf-16"]:
-                        try:
-                            strings_copy[i] = strings[i].decode(x)
-                            self.encoding = x
-                            # This looks sketchy, but it will always work since @UTF only supports these 3 encodings. 
-                            break
-                        except:
-                            continue
-                    else:
-                        # Probably useless.
-                        raise UnicodeDecodeError(f"String of unknown encoding: {strings[i]}")
-        t_t_dict = dict()
-        self.table_name = strings_copy[self.finder(self.table_name, strings)]
-        UTFTypeValuesList = list(UTFTypeValues)
-        for i in range(len(target_constant)):
-            if types[2][i][1] not in [0xA, 0xB]:
-                val = self.finder(target_constant[i], strings)
-                table.setdefault(strings_copy[val], []).append(0)
-                t_t_dict.update({strings_copy[val]: (UTFTypeValuesList[types[2][i][1]], None)})
-            elif types[2][i][1] == 0xA:
-                val = self.finder(target_constant[i], strings)
-                table.setdefault(strings_copy[val], []).append("<NULL>")
-                t_t_dict.update({strings_copy[val]: (UTFTypeValues.string, "<NULL>")})
-            else:
-                # Most likely useless, since the code doesn seem to reach here.
-                val = self.finder(target_constant[i], strings)
-                table.setdefault(strings_copy[val], []).append(b'')
-                t_t_dict.update({strings_copy[val]: (UTFTypeValues.bytes, b'')})
-        for i in range(len(target_tuple)):
-            if types[1][i%(len(types[1]))][1] not in [0xA, 0xB]:
-                table.setdefault(strings_copy[self.finder(target_tuple[i][0], strings)], []).append(target_tuple[i][1])
-                t_t_dict.update({strings_copy[self.finder(target_tuple[i][0], strings)]: (UTFTypeValuesList[types[1][i%len(types[1])][1]], target_tuple[i][1][0])})
-            elif types[1][i%(len(types[1]))][1] == 0xA:
-                table.setdefault(strings_copy[self.finder(target_tuple[i][0], strings)], []).append(strings_copy[self.finder(target_tuple[i][1][0], strings)])
-                t_t_dict.update({strings_copy[self.finder(target_tuple[i][0], strings)]: (UTFTypeValues.string, strings_copy[self.finder(target_tuple[i][1][0], strings)])})
+        return columns
+
+    def read_array(self, typeflag: int, values: bytes) -> list:
+        """ Converts a native column array from CriCodecs.UtfParse into table values. """
+        if typeflag == 0xA:
+            strings = self.__strings
+            return [strings[x] for x in array("I", values)]
+        elif typeflag == 0xB:
+            binary = self.data_offset + 0x8
+            values = array("I", values)
+            return [bytes(self.data[binary+x:binary+x+y]) for x, y in zip(values[0::2], values[1::2])]
+        else:
+            return array(self.stringtypes(typeflag), values).tolist()
+
+    def read_values(self, indexes: list) -> None:
+        """ Decodes the given 0x50 columns of all rows in one pass, with a row Struct that skips every other column. """
+        indexes = sorted([i for i in indexes if i not in self.__values], key=lambda x: self.__schema[x][3])
+        if not indexes:
+            return
+        row_format = ">"
+        pos = 0
+        for i in indexes:
+            stflag, typeflag, name, offset = self.__schema[i]
+            if offset > pos:
+                row_format += f"{offset - pos}x"
+            row_format += self.stringtypes(typeflag)
+            pos = offset + calcsize(">"+self.stringtypes(typeflag))
+        if self.row_length > pos:
+            row_format += f"{self.row_length - pos}x"
+        rows = Struct(row_format)
+        start = self.rows_offset + 0x8
+        fields = list(zip(*rows.iter_unpack(self.data[start:start+rows.size*self.num_rows])))
+        if not fields:
+            fields = [()] * len(row_format)
+        strings = self.__strings
+        binary = self.data_offset + 0x8
+        field = 0
+        for i in indexes:
+            typeflag = self.__schema[i][1]
+            if typeflag == 0xA:
+                self.__values[i] = [strings[x] for x in fields[field]]
+            elif typeflag == 0xB:
+                self.__values[i] = [bytes(self.data[binary+x:binary+x+y]) for x, y in zip(fields[field], fields[field+1])]
+                field += 1
             else:
-                self.stream.seek(self.data_offset+target_tuple[i][1][0]+0x8, 0)
-                bin_val = self.stream.read((target_tuple[i][1][1]))
-                table.setdefault(strings_copy[self.finder(target_tuple[i][0], strings)], []).append(bin_val)
-                t_t_dict.update({strings_copy[self.finder(target_tuple[i][0], strings)]: (UTFTypeValues.bytes, bin_val)})
-        temp_dict = dict()
-        if len(rows) == 0:
-            self.__payload.append(t_t_dict)
-        for i in range(len(rows)):
-            if types[0][i%(len(types[0]))][1] not in [0xA, 0xB]:
-                table.setdefault(strings_copy[self.finder(target_data[i%(len(target_data))], strings)], []).append(rows[i][0])
-                temp_dict.update({strings_copy[self.finder(target_data[i%(len(target_data))], strings)]: (UTFTypeValuesList[types[0][i%(len(types[0]))][1]], rows[i][0])})
-            elif types[0][i%(len(types[0]))][1] == 0xA:
-                table.setdefault(strings_copy[self.finder(target_data[i%(len(target_data))], strings)], []).append(strings_copy[self.finder(rows[i][0], strings)])
-                temp_dict.update({strings_copy[self.finder(target_data[i%(len(target_data))], strings)]: (UTFTypeValues.string, strings_copy[self.finder(rows[i][0], strings)])})
+                self.__values[i] = list(fields[field])
+            field += 1
+
+    def read_column(self, index: int) -> list:
+        """ Returns the table values of a single column. """
+        stflag, typeflag, name, value = self.__schema[index]
+        if stflag == 0x10:
+            return [0 if value is None else value]
+        elif stflag == 0x30:
+            return [value]
+        self.read_values([index])
+        return list(self.__values[index])
+
+    def read_rows_and_columns(self) -> dict:
+        table = dict()
+        self.read_values([i for i, x in enumerate(self.__schema) if x[0] == 0x50])
+        for i in self.column_order():
+            name = self.__schema[i][2]
+            if self.__schema[i][0] == 0x50 and not self.__values[i]:
+                continue
+            elif name in table:
+                table[name] = table[name] + self.read_column(i)
             else:
-                self.stream.seek(self.data_offset+rows[i][0]+0x8, 0)
-                bin_val = self.stream.read((rows[i][1]))
-                table.setdefault(strings_copy[self.finder(target_data[i%(len(target_data))], strings)], []).append(bin_val)
-                temp_dict.update({strings_copy[self.finder(target_data[i%(len(target_data))], strings)]: (UTFTypeValues.bytes, bin_val)})
-            if not (i+1)%(len(types[0])):
-                temp_dict.update(t_t_dict)
-                self.__payload.append(temp_dict)
-                temp_dict = dict()
+                table[name] = self.read_column(i)
         return table
+
+    def column_order(self) -> list:
+        """ Column indexes in table order, constant columns come first. """
+        return [i for storage in [0x10, 0x30, 0x50] for i, x in enumerate(self.__schema) if x[0] == storage]
+
+    def columns(self, names: list) -> dict:
+        """ Returns a dict of only the given columns, decoding the needed rows in a single pass. """
+        indexes = [i for i in self.column_order() if self.__schema[i][2] in names]
+        self.read_values([i for i in indexes if self.__schema[i][0] == 0x50])
+        columns = dict()
+        for i in indexes:
+            name = self.__schema[i][2]
+            if self.__schema[i][0] == 0x50 and not self.__values[i]:
+                continue
+            elif name in columns:
+                columns[name] = columns[name] + self.read_column(i)
+            else:
+                columns[name] = self.read_column(i)
+        for name in names:
+            if name not in columns:
+                raise KeyError(name)
+        return {name: columns[name] for name in names}
+
+    def column_names(self) -> list:
+        """ Returns all column names in table order. """
+        names = []
+        for i in self.column_order():
+            stflag, typeflag, name, value = self.__schema[i]
+            if name not in names and (stflag != 0x50 or self.num_rows):
+                names.append(name)
+        return names
+
+    def cell(self, name: str, row: int) -> tuple:
+        """ Returns the (type, offset) of a cell in the table data, or None if the column is not stored per row. """
+        if not 0 <= row < self.num_rows:
+            raise IndexError(f"Row {row} out of range.")
+        for i in self.column_order():
+            stflag, typeflag, column, value = self.__schema[i]
+            if column == name:
+                if stflag != 0x50:
+                    return None
+                return typeflag, self.rows_offset + 0x8 + row * self.row_length + value
+        raise KeyError(name)
+
+    def read_strings(self, pool: bytes, pools: dict = None) -> dict:
+        """ Returns a string pool map of offsets to decoded strings, looked up in pools first if given. """
+        if pools is None:
+            strings = read_string_pool(pool)
+        else:
+            strings = pools.get(pool)
+            if strings is None:
+                strings = pools[pool] = read_string_pool(pool)
+        self.encoding = strings.encoding
+        return strings
     
     def stringtypes(self, type: int) -> str:
         types = "BbHhIiQqfdI"
@@ -163,16 +322,6 @@ class UTF:
             return("II")
         else:
             raise Exception("Unkown data type.")
-
-    def finder(self, pointer, strings) -> int:
-        sum = 0
-        for i in range(len(strings)):
-            if sum < pointer:
-                sum += len(strings[i]) + 1
-                continue
-            return i
-        else:
-            raise Exception("Failed string lookup.")
     
     def get_payload(self) -> list:
         """ Returns list of dictionaries used in the UTF. """
@@ -184,14 +333,135 @@ class UTF:
         # As for key strings, according to Donmai, they are always in ASCII encoding
         # despite, what seems to me, nothing stopping it for being any of the other 3 encodings,
         # since the header allows it.
+        if self.__payload is None:
+            UTFTypeValuesList = list(UTFTypeValues)
+            self.read_values([i for i, x in enumerate(self.__schema) if x[0] == 0x50])
+            constants = dict()
+            rows = []
+            for i in self.column_order():
+                stflag, typeflag, name, value = self.__schema[i]
+                if stflag == 0x50:
+                    if self.__values[i]:
+                        rows.append((name, UTFTypeValuesList[typeflag], self.__values[i]))
+                elif stflag == 0x30 and typeflag < 0xA:
+                    constants[name] = (UTFTypeValuesList[typeflag], value[0])
+                else:
+                    constants[name] = (UTFTypeValuesList[typeflag], value)
+            if not rows:
+                self.__payload = [constants]
+            else:
+                self.__payload = []
+                for i in range(len(rows[0][2])):
+                    row = {name: (typ, value[i]) for name, typ, value in rows}
+                    row.update(constants)
+                    self.__payload.append(row)
         return self.__payload
 
+class StringPool(dict):
+    """ Offset to string map of a @UTF string pool, resolves pointers that are not at a string start. """
+    __slots__ = ["pool", "encoding"]
+    pool: bytes
+    encoding: str
+    def __init__(self, pool: bytes) -> None:
+        self.pool = pool
+
+    def __missing__(self, pointer: int) -> str:
+        if pointer >= len(self.pool):
+            raise Exception("Failed string lookup.")
+        end = self.pool.find(b'\x00', pointer)
+        return self.pool[pointer:end if end != -1 else len(self.pool)].decode(self.encoding)
+
+class UTFTableView(Mapping):
+    """ Read-only table of a lazy UTF, a column is decoded on its first access. """
+    __slots__ = ["utf", "names", "cache"]
+    utf: UTF
+    names: list
+    cache: dict
+    def __init__(self, utf: UTF) -> None:
+        self.utf = utf
+        self.names = utf.column_names()
+        self.cache = dict()
+
+    def __getitem__(self, name: str) -> list:
+        if name not in self.cache:
+            if name not in self.names:
+                raise KeyError(name)
+            self.cache[name] = self.utf.columns([name])[name]
+        return self.cache[name]
+
+    def __contains__(self, name) -> bool:
+        return name in self.names
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+class UTFPatcher:
+    """ Use this class to change values of an existing @UTF table in place. """
+    __slots__ = ["data", "utf", "encrypted"]
+    data: bytearray
+    utf: UTF
+    encrypted: bool
+    def __init__(self, data: bytearray) -> None:
+        # Cells stored per row are overwritten in the given buffer, strings and binary data can only point
+        # to what is already in the table, anything else rebuilds the table into a new buffer.
+        self.data = data
+        self.utf = UTF(data, lazy=True)
+        self.encrypted = bytes(data[:4]) == UTFType.EUTF.value
+
+    def set(self, name: str, row: int, value) -> bool:
+        """ Sets a value of the table, returns False if the table had to be rebuilt. """
+        cell = self.utf.cell(name, row)
+        if cell is not None:
+            typeflag, offset = cell
+            data = self.pack(typeflag, value)
+            if data is not None:
+                self.write(offset, data)
+                return True
+        payload = UTF(bytes(self.data)).get_payload()
+        payload[row][name] = (payload[row][name][0], value)
+        self.data = UTFBuilder(payload, encrypt=self.encrypted, encoding=self.utf.encoding, table_name=self.utf.table_name).parse()
+        self.utf = UTF(self.data, lazy=True)
+        return False
+
+    def pack(self, typeflag: int, value) -> bytes:
+        """ Returns the cell bytes of a value, or None if it is not in the string pool or binary area. """
+        utf = self.utf
+        if typeflag == 0xA:
+            pool = bytes(utf.data[utf.string_offset+0x8:utf.data_offset+0x8])
+            string = value.encode(utf.encoding)
+            if pool.startswith(string + b'\x00'):
+                pointer = 0
+            else:
+                pointer = pool.find(b'\x00' + string + b'\x00') + 1
+                if pointer == 0:
+                    return None
+            return pack(">I", pointer)
+        elif typeflag == 0xB:
+            if not value:
+                return pack(">II", 0, 0)
+            pointer = bytes(utf.data[utf.data_offset+0x8:utf.table_size+0x8]).find(value)
+            if pointer == -1:
+                return None
+            return pack(">II", pointer, len(value))
+        return pack(">"+utf.stringtypes(typeflag), value)
+
+    def write(self, offset: int, data: bytes) -> None:
+        if self.encrypted:
+            # The lazy table holds a decrypted copy, while the buffer holds the encrypted cells.
+            self.utf.data[offset:offset+len(data)] = data
+            data = bytearray(data)
+            utf_crypt(data, offset)
+        self.data[offset:offset+len(data)] = data
+
 # Revised it a bit.
 class UTFBuilder:
     """ Use this class to build custom UTF tables. """
     __slots__ = ["encoding", "dictarray", "keyset", "encrypt", "encoding", "strings", 
                 "table_name", "binary", "table", "rows_data", "stflag", "column_data",
-                "data_offset"]
+                "data_offset", "string_list", "string_offsets", "binary_offsets", "rows_size"]
     encoding: str
     dictarray: list
     strings: bytes
@@ -202,6 +472,10 @@ class UTFBuilder:
     rows_data: bytearray
     column_data: bytearray
     data_offset: int
+    string_list: list
+    string_offsets: dict
+    binary_offsets: dict
+    rows_size: int
     
     def __init__(self, dictarray: list, encrypt: bool = False, encoding: str = "utf-8", table_name: str = "PyCriCodecs_table") -> None:
         l = set([len(x) for x in dictarray])
@@ -220,28 +494,55 @@ class UTFBuilder:
 
     def parse(self) -> bytearray:
         """ Returns a @UTF bytearray Table from the provided payload dict. """
-        self.get_stflag()
-        self.column_data = self.write_columns()
-        self.rows_data = self.write_rows()
+        self.layout()
         header_data = self.write_header()
-        dataarray = header_data + self.column_data + self.rows_data + self.strings + self.binary
-        if len(dataarray) % 8 != 0:
-            dataarray = dataarray[:8] + dataarray[8:].ljust(self.data_offset, b'\x00') # Padding.
+        self.rows_data = self.write_rows()
+        # Sections are copied once into a buffer that is already padded to its final size.
+        dataarray = bytearray(self.data_offset + 0x8)
+        pos = 0
+        for section in [header_data, self.column_data, self.rows_data, self.strings, self.binary]:
+            dataarray[pos:pos+len(section)] = section
+            pos += len(section)
         if self.encrypt:
-            dataarray = memoryview(dataarray)
-            m = 0x655f
-            t = 0x4115
-            for i in range(len(dataarray)):
-                dataarray[i] ^= (0xFF & m)
-                m = (m * t) & 0xFFFFFFFF
-            dataarray = bytearray(dataarray)
+            utf_crypt(dataarray)
         return dataarray
-    
-    def write_header(self) -> bytearray:
-        self.data_offset = len(self.column_data) + len(self.rows_data) + len(self.strings) + len(self.binary) + 0x18
-        datalen = self.data_offset
+
+    def write_to(self, fileobj, chunk_rows: int = 0x1000) -> int:
+        """ Writes the @UTF Table to a file object section by section, without building it in memory first.
+        Rows are packed chunk_rows at a time, returns the size of the table. """
+        self.layout()
+        size = self.data_offset + 0x8
+        pos = 0
+        def write(data):
+            nonlocal pos
+            # Data is written at most 1MiB at a time, so that encrypting does not copy whole sections.
+            for i in range(0, len(data), 0x100000):
+                piece = data[i:i+0x100000]
+                if self.encrypt:
+                    piece = bytearray(piece)
+                    utf_crypt(piece, pos)
+                fileobj.write(piece)
+                pos += len(piece)
+        write(self.write_header())
+        write(self.column_data)
+        for i in range(0, len(self.dictarray), chunk_rows):
+            write(self.write_rows(i, i+chunk_rows))
+        write(memoryview(self.strings))
+        write(memoryview(self.binary))
+        write(bytes(size - pos))
+        return size
+
+    def layout(self) -> None:
+        """ First pass, works out every section size so the header can be written before the rows. """
+        self.get_stflag()
+        self.column_data = self.write_columns()
+        self.rows_size = self.get_row().size * len(self.dictarray)
+        self.data_offset = len(self.column_data) + self.rows_size + len(self.strings) + len(self.binary) + 0x18
         if self.data_offset % 8 != 0:
             self.data_offset = self.data_offset + (8 - self.data_offset % 8)
+    
+    def write_header(self) -> bytearray:
+        datalen = len(self.column_data) + self.rows_size + len(self.strings) + len(self.binary) + 0x18
         if len(self.binary) == 0:
             binary_offset = self.data_offset
         else:
@@ -252,43 +553,55 @@ class UTFBuilder:
                         len(self.column_data)+0x18, # Rows offset.
                         datalen-len(self.strings)-len(self.binary), # String offset.
                         binary_offset, # Binary data offset.
-                        0 if self.strings.startswith(bytes(self.table_name, self.encoding)) else self.strings.index(b"\x00" + bytes(self.table_name, self.encoding) + b"\x00") + 1, # Table name pointer.
+                        0 if self.string_list[0] == self.table_name else self.string_offsets[self.table_name], # Table name pointer.
                         len(self.stflag), # Num columns.
-                        sum([calcsize(self.stringtypes(x[1])) for x in self.stflag if x[0] == 0x50]), # Num rows.
+                        self.get_row().size, # Num rows.
                         len(self.dictarray) # Rows length.
                     )
         return bytearray(header)
+
+    def get_row(self) -> Struct:
+        return Struct(">"+"".join([self.stringtypes(x[1]) for x in self.stflag if x[0] == 0x50]))
     
-    def write_rows(self) -> bytearray:
-        rows = bytearray()
-        for dict in self.dictarray:
-            for data in self.stflag:
-                if data[0] == 0x50:
-                    if data[1] not in [0xA, 0xB]:
-                        rows += pack(">"+self.stringtypes(data[1]), dict[data[2]][1])
-                    elif data[1] == 0xA:
-                        if bytes(dict[data[2]][1], self.encoding) == b"":
-                            idx = self.strings.index(b'\x00\x00') + 1
-                            rows += pack(">"+self.stringtypes(data[1]), idx)
-                        else:
-                            rows += pack(">"+self.stringtypes(data[1]), self.strings.index(b"\x00" + bytes(dict[data[2]][1], self.encoding) + b"\x00") + 1)
-                    else:
-                        rows += pack(">"+self.stringtypes(data[1]), self.binary.index(dict[data[2]][1]), len(dict[data[2]][1]))
+    def write_rows(self, start: int = 0, stop: int = None) -> bytearray:
+        """ Packs the rows from start to stop, all of them by default. """
+        # All rows share one precompiled Struct, strings and binary data are looked up in the offset maps.
+        columns = [(data[1], data[2]) for data in self.stflag if data[0] == 0x50]
+        row = self.get_row()
+        dictarray = self.dictarray[start:stop]
+        rows = bytearray(row.size * len(dictarray))
+        if not columns:
+            return rows
+        strings = self.string_offsets
+        binary = self.binary_offsets
+        pos = 0
+        for dict in dictarray:
+            values = []
+            for typeflag, name in columns:
+                value = dict[name][1]
+                if typeflag == 0xA:
+                    values.append(strings[value])
+                elif typeflag == 0xB:
+                    values.append(binary[bytes(value)])
+                    values.append(len(value))
+                else:
+                    values.append(value)
+            row.pack_into(rows, pos, *values)
+            pos += row.size
         return rows
 
     def write_columns(self) -> bytearray:
         columns = bytearray()
         for data in self.stflag:
             columns += int.to_bytes(data[0] | data[1], 1, "big")
-            if data[0] in [0x10, 0x50]:
-                columns += int.to_bytes(self.strings.index(b"\x00" + bytes(data[2], self.encoding) + b"\x00") + 1, 4, "big")
-            else:
+            columns += int.to_bytes(self.string_offsets[data[2]], 4, "big")
+            if data[0] == 0x30:
                 if data[1] not in [0xA, 0xB]:
-                    columns += int.to_bytes(self.strings.index(b"\x00" + bytes(data[2], self.encoding) + b"\x00") + 1, 4, "big")+int.to_bytes(data[3], calcsize(self.stringtypes(data[1])), "big")
+                    columns += pack(">"+self.stringtypes(data[1]), data[3])
                 elif data[1] == 0xA:
-                    columns += int.to_bytes(self.strings.index(b"\x00" + bytes(data[2], self.encoding) + b"\x00") + 1, 4, "big") + (b"\x00\x00\x00\x00" if self.strings.startswith(bytes(data[3], self.encoding) + b"\x00") else (int.to_bytes(self.strings.index(b"\x00" + bytes(data[3], self.encoding) + b"\x00") + 1, 4, "big")))
+                    columns += int.to_bytes(0 if self.string_list[0] == data[3] else self.string_offsets[data[3]], 4, "big")
                 else:
-                    columns += int.to_bytes(self.strings.index(b"\x00" + bytes(data[2], self.encoding) + b"\x00") + 1, 4, "big")+int.to_bytes(self.binary.index(data[3]), 4, "big")+int.to_bytes(len(data[3]), 4, "big")
+                    columns += int.to_bytes(self.binary_offsets[bytes(data[3])], 4, "big")+int.to_bytes(len(data[3]), 4, "big")
         return columns
 
     def get_stflag(self):
@@ -315,35 +628,52 @@ class UTFBuilder:
                     self.stflag.append((0x50, UTFTypeValuesList.index(val[1][0]), val[0]))
 
     def get_strings(self):
-        strings = []
-        binary = b''
-
-        for dict in self.dictarray:
-            for key, value in dict.items():
-                if key not in strings:
-                    strings.append(key)
-        for dict in self.dictarray:
-            for key, value in dict.items():
-                if type(value[1]) == str and value[1] not in strings:
-                    strings.append(value[1])
-                if (type(value[1]) == bytearray or type(value[1]) == bytes) and value[1] not in binary:
-                    binary += value[1]
-        self.binary = binary
-
-        strings = [self.table_name] + strings
+        # Strings and binary data are interned once into offset maps, instead of searching the pools for every cell.
+        strings = dict()
+        binary = []
+        self.binary_offsets = dict()
+        size = 0
+
+        for dict_ in self.dictarray:
+            for key in dict_:
+                strings[key] = None
+        for dict_ in self.dictarray:
+            for key, value in dict_.items():
+                if type(value[1]) == str:
+                    strings.setdefault(value[1], None)
+                elif type(value[1]) == bytearray or type(value[1]) == bytes:
+                    value = bytes(value[1])
+                    if not value:
+                        self.binary_offsets[value] = 0
+                    elif value not in self.binary_offsets:
+                        self.binary_offsets[value] = size
+                        binary.append(value)
+                        size += len(value)
+        self.binary = b''.join(binary)
+
+        strings = [self.table_name] + list(strings)
 
         if "<NULL>" in strings:
             strings.pop(strings.index("<NULL>"))
             strings = ["<NULL>"] + strings
+        self.string_list = strings
 
-        for i in range(len(strings)):
-            val = strings[i].encode(self.encoding)
+        # A string is referenced at its first appearance after the first string,
+        # the first string is only referenced by its own offset when it does not appear again.
+        self.string_offsets = dict()
+        encoded = []
+        offset = 0
+        for string in strings:
+            val = string.encode(self.encoding)
             if b'\x00' in val:
-                raise ValueError(f"Encoding of {self.encoding} for '{strings[i]}' results in string with a null byte.")
-            else:
-                strings[i] = val
+                raise ValueError(f"Encoding of {self.encoding} for '{string}' results in string with a null byte.")
+            if offset:
+                self.string_offsets.setdefault(string, offset)
+            encoded.append(val)
+            offset += len(val) + 1
+        self.string_offsets.setdefault(strings[0], 0)
         
-        self.strings = b'\x00'.join(strings) + b"\x00"
+        self.strings = b'\x00'.join(encoded) + b"\x00"
         
     def stringtypes(self, type: int) -> str:
         types = "BbHhIiQqfdI"